@@ -0,0 +1,85 @@
+"""Measure cold-start vs warm latency of the qwen3:8b categorize call.
+
+Usage:
+    uv run bench_warm.py [receipt_text.txt] [--runs 3]
+
+The model is unloaded first (keep_alive=0), so the first call pays the model
+load and the full prompt evaluation. Later calls reuse the loaded model and the
+cached system-prompt prefix, which shows up as fewer evaluated prompt tokens.
+The last run comes right after a shipment extraction call, to show whether the
+categorize prefix is still cached once another prompt has used the slot (with
+OLLAMA_NUM_PARALLEL=1 it isn't).
+"""
+import argparse
+import time
+
+import requests
+
+from server import CATEGORIZE_PROMPT, SHIPMENT_PROMPT, ollama_keep_alive
+
+SAMPLE = """
+KEDAI MAKAN ABC
+Nasi Lemak x2   RM 12.00
+Teh Tarik x2    RM  5.00
+SST 6%          RM  1.02
+Total           RM 18.02
+"""
+
+
+def chat(content, prompt=CATEGORIZE_PROMPT):
+    payload = {
+        "model": "qwen3:8b",
+        "messages": [
+            {"role": "system", "content": prompt},
+            {"role": "user", "content": content},
+        ],
+        "stream": False,
+        "keep_alive": ollama_keep_alive,
+    }
+    started = time.perf_counter()
+    response = requests.post("http://localhost:11434/api/chat", json=payload)
+    elapsed = time.perf_counter() - started
+    if response.status_code != 200:
+        raise RuntimeError(f"API error: {response.text}")
+    data = response.json()
+    return {
+        "total_s": elapsed,
+        "load_s": data.get("load_duration", 0) / 1e9,
+        "prompt_tokens": data.get("prompt_eval_count", 0),
+        "prompt_eval_s": data.get("prompt_eval_duration", 0) / 1e9,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("receipt", nargs="?", help="text file with OCR output to categorize")
+    parser.add_argument("--runs", type=int, default=3, help="number of warm runs")
+    args = parser.parse_args()
+
+    content = SAMPLE
+    if args.receipt:
+        with open(args.receipt, encoding="utf-8") as f:
+            content = f.read()
+
+    # Unload the model so the first request is a real cold start
+    requests.post(
+        "http://localhost:11434/api/generate", json={"model": "qwen3:8b", "keep_alive": 0}
+    )
+
+    rows = [("cold", chat(content))]
+    for i in range(args.runs):
+        rows.append((f"warm {i + 1}", chat(content)))
+    chat(content, SHIPMENT_PROMPT)
+    rows.append(("after shipment prompt", chat(content)))
+
+    print("| Run | Total (s) | Model load (s) | Prompt tokens evaluated | Prompt eval (s) |")
+    print("|---|---|---|---|---|")
+    for name, r in rows:
+        print(
+            f"| {name} | {r['total_s']:.2f} | {r['load_s']:.2f} "
+            f"| {r['prompt_tokens']} | {r['prompt_eval_s']:.2f} |"
+        )
+
+
+if __name__ == "__main__":
+    main()
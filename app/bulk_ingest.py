@@ -0,0 +1,236 @@
+"""Bulk-ingest a directory of receipt images through the OCR pipeline.
+
+Runs the same steps as the server endpoints (OCR -> categorize -> extract ->
+store) in-process, with a separate concurrency limit per stage. Progress is
+appended to a checkpoint file keyed by the SHA-256 of each image, so an
+interrupted run can simply be started again and already-processed files
+(including copies under another name) are skipped.
+
+Usage:
+    uv run bulk_ingest.py ~/scans                      # every image under ~/scans
+    uv run bulk_ingest.py "~/scans/2025-*/*.jpeg" --backend ollama --ocr-workers 1 --llm-workers 4
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import server
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff"}
+
+
+def find_images(source):
+    source = os.path.expanduser(source)
+    if os.path.isdir(source):
+        paths = (
+            os.path.join(root, name)
+            for root, _, names in os.walk(source)
+            for name in names
+        )
+    else:
+        paths = glob.glob(source, recursive=True)
+    return sorted(p for p in paths if os.path.splitext(p)[1].lower() in IMAGE_EXTENSIONS)
+
+
+class Checkpoint:
+    """Append-only JSON-lines record of processed files."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = set()
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    if record["status"] == "done":
+                        self.done.add(record["sha256"])
+
+    def record(self, **record):
+        with self.lock:
+            if record["status"] == "done":
+                self.done.add(record["sha256"])
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+
+def ocr(image_bytes, backend):
+    if backend == "ollama":
+        content = server.ollama_ocr(image_bytes)
+    else:
+        content = server.deepseek_ocr(image_bytes)
+    # The OCR helpers report failures as text instead of raising
+    if content.startswith("An error occurred:"):
+        raise RuntimeError(content)
+    return content
+
+
+def extract(content):
+    data = json.loads(server.categorize(content))
+    if data.get("shipment"):
+        kind, extract_items = "shipment", server.extract_shipment
+    elif data.get("non shipment"):
+        kind, extract_items = "non shipment", server.extract_non_shipment
+    else:
+        raise ValueError(f"No category in categorize output: {data}")
+
+    items = server.clean_and_validate_json(extract_items(content, data[kind]))
+    if isinstance(items, dict):
+        items = [items]
+    if not items:
+        raise ValueError("Extraction did not return valid JSON")
+    return kind, items
+
+
+def store(kind, items, on_stored):
+    if kind == "shipment":
+        result = server.store_shipment_data(items, on_stored)
+    else:
+        result = server.store_non_shipment_data(items, on_stored)
+    if result[0] == "Error occurred:":
+        raise RuntimeError(str(result[1]))
+    return result
+
+
+class Stopped(Exception):
+    """Raised between stages once the run has been interrupted."""
+
+
+class Pipeline:
+    def __init__(self, args, checkpoint):
+        self.backend = args.backend
+        self.checkpoint = checkpoint
+        self.slots = {
+            "ocr": threading.BoundedSemaphore(args.ocr_workers),
+            "extract": threading.BoundedSemaphore(args.llm_workers),
+            "store": threading.BoundedSemaphore(args.db_workers),
+        }
+        self.lock = threading.Lock()
+        self.in_progress = set()
+        self.stats = {"done": 0, "failed": 0, "skipped": 0}
+        self.stage_seconds = {stage: 0.0 for stage in self.slots}
+        self.stopping = threading.Event()
+
+    def stage(self, name, func, *args):
+        if self.stopping.is_set():
+            raise Stopped()
+        with self.slots[name]:
+            started = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                elapsed = time.perf_counter() - started
+                with self.lock:
+                    self.stage_seconds[name] += elapsed
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def process(self, path):
+        with open(path, "rb") as f:
+            image_bytes = f.read()
+        sha256 = hashlib.sha256(image_bytes).hexdigest()
+
+        # Skip files already ingested, and copies of a file another worker is on
+        with self.lock:
+            if sha256 in self.checkpoint.done or sha256 in self.in_progress:
+                self.stats["skipped"] += 1
+                return
+            self.in_progress.add(sha256)
+
+        started = time.perf_counter()
+
+        def finish(status, **record):
+            self.count(status)
+            self.checkpoint.record(
+                sha256=sha256, path=path, status=status, **record,
+                seconds=round(time.perf_counter() - started, 3),
+            )
+            with self.lock:
+                self.in_progress.discard(sha256)
+
+        def stored():
+            print(f"done   {path} ({kind}, {len(items)} rows)")
+            finish("done", category=kind, rows=len(items))
+
+        try:
+            content = self.stage("ocr", ocr, image_bytes, self.backend)
+            kind, items = self.stage("extract", extract, content)
+            # With write-behind the rows are only queued here, and stored() runs on the
+            # writer thread once they are flushed or spilled, so a crash before then
+            # leaves the file to be picked up again by the next run
+            self.stage("store", store, kind, items, stored)
+        except Stopped:
+            with self.lock:
+                self.in_progress.discard(sha256)
+        except Exception as e:
+            print(f"FAILED {path}: {e}")
+            finish("failed", error=str(e))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk-ingest receipt images through the OCR pipeline.")
+    parser.add_argument("source", help="directory (searched recursively) or glob pattern of images")
+    parser.add_argument("--backend", choices=("deepseek", "ollama"), default="deepseek", help="OCR backend")
+    parser.add_argument("--checkpoint", default="server/bulk-ingest.checkpoint.jsonl", help="checkpoint file")
+    parser.add_argument("--ocr-workers", type=int, default=1, help="concurrent OCR requests")
+    parser.add_argument("--llm-workers", type=int, default=2, help="concurrent categorize/extract calls")
+    parser.add_argument("--db-workers", type=int, default=2, help="concurrent database inserts")
+    parser.add_argument("--write-behind", action="store_true", help="batch inserts with the write-behind COPY writer")
+    args = parser.parse_args()
+
+    paths = find_images(args.source)
+    checkpoint = Checkpoint(args.checkpoint)
+    pipeline = Pipeline(args, checkpoint)
+    print(f"Found {len(paths)} images, {len(checkpoint.done)} already in {args.checkpoint}")
+
+    # write_behind=true in .env enables the writer as well
+    if args.write_behind and server.db_writer is None:
+        server.db_writer = server.make_db_writer()
+    if server.db_writer is not None:
+        server.db_writer.start()
+
+    started = time.perf_counter()
+    workers = args.ocr_workers + args.llm_workers + args.db_workers
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        list(pool.map(pipeline.process, paths))
+    except KeyboardInterrupt:
+        print("\nInterrupted: dropping queued files and letting in-flight ones finish their current stage")
+        pipeline.stopping.set()
+    finally:
+        # Workers must be stopped before the writer is closed, or rows they store
+        # afterwards would be queued behind the final drain and lost
+        while True:
+            try:
+                pool.shutdown(wait=True, cancel_futures=True)
+                break
+            except KeyboardInterrupt:
+                print("Still waiting for in-flight files...")
+        if server.db_writer is not None:
+            server.db_writer.close()
+    elapsed = time.perf_counter() - started
+
+    stats = pipeline.stats
+    processed = stats["done"] + stats["failed"]
+    print()
+    print(f"Processed {processed} files in {elapsed:.1f}s "
+          f"({stats['done']} done, {stats['failed']} failed, {stats['skipped']} skipped)")
+    if processed:
+        print(f"Throughput: {stats['done'] / elapsed:.2f} receipts/s, {elapsed / processed:.1f}s per file")
+        for stage, seconds in pipeline.stage_seconds.items():
+            print(f"  {stage:<8} {seconds / processed:6.1f}s avg")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Postgres connection, table definitions and migrations shared by the server and CLIs."""
+import os
+
+import psycopg2
+from dotenv import load_dotenv
+from psycopg2 import Error
+
+# Load .env file
+load_dotenv()
+
+# Access environment variables
+database = os.getenv("database")
+user = os.getenv("user")
+password = os.getenv("password")
+
+SHIPMENT_TABLE = """
+        CREATE TABLE IF NOT EXISTS shipment_invoice (
+            id SERIAL PRIMARY KEY,
+            category VARCHAR(100),
+            delivery_company VARCHAR(100),
+            shipment_content VARCHAR(300),
+            quantity NUMERIC,
+            sender VARCHAR(100),
+            receiver VARCHAR(100),
+            sender_address VARCHAR(300),
+            receiver_address VARCHAR(300),
+            barcode TEXT[],
+            created_at TIMESTAMPTZ DEFAULT now()
+        )
+        """
+
+NON_SHIPMENT_TABLE = """
+            CREATE TABLE IF NOT EXISTS non_shipment_invoice (
+                id SERIAL PRIMARY KEY,
+                category VARCHAR(100),
+                name VARCHAR(100),
+                raw_data VARCHAR(5000),
+                total_price VARCHAR(100),
+                SST VARCHAR(100),
+                Service_Charge VARCHAR(100),
+                created_at TIMESTAMPTZ DEFAULT now()
+            )
+        """
+
+
+def connect_db():
+    return psycopg2.connect(
+        dbname=database,
+        user=user,
+        password=password,
+        host="localhost",
+        port="5432",
+    )
+
+
+# Adds created_at to tables created before it existed. ALTER TABLE takes an ACCESS
+# EXCLUSIVE lock even when the column is already there, which would queue every
+# insert behind any open export, so it only runs when the column is missing.
+MIGRATIONS = (
+    ("shipment_invoice", "created_at",
+     "ALTER TABLE shipment_invoice ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ DEFAULT now()"),
+    ("non_shipment_invoice", "created_at",
+     "ALTER TABLE non_shipment_invoice ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ DEFAULT now()"),
+)
+
+
+def migrate_db():
+    conn = None
+    try:
+        conn = connect_db()
+        with conn.cursor() as cur:
+            cur.execute(SHIPMENT_TABLE)
+            cur.execute(NON_SHIPMENT_TABLE)
+            for table, column, statement in MIGRATIONS:
+                cur.execute(
+                    "SELECT 1 FROM information_schema.columns WHERE table_name = %s AND column_name = %s",
+                    (table, column),
+                )
+                if cur.fetchone() is None:
+                    cur.execute(statement)
+        conn.commit()
+    except Error as e:
+        print("Database migration failed:", e)
+    finally:
+        if conn:
+            conn.close()
@@ -0,0 +1,251 @@
+import csv
+import io
+import json
+import os
+import queue
+import threading
+import time
+
+
+def array_literal(values):
+    """Format a Python list as a Postgres array literal for COPY."""
+    escaped = (
+        str(v).replace("\\", "\\\\").replace('"', '\\"') for v in values
+    )
+    return "{" + ",".join(f'"{v}"' for v in escaped) + "}"
+
+
+def copy_value(value):
+    if value is None:
+        return "\\N"
+    if isinstance(value, (list, tuple)):
+        return array_literal(value)
+    return value
+
+
+def countdown(count, callback):
+    """Return a function that calls callback on its count-th call."""
+    lock = threading.Lock()
+    remaining = [count]
+
+    def done():
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        callback()
+
+    return done
+
+
+class WriteBehindWriter:
+    """Batch inserts off the request path.
+
+    Rows are put on an in-process queue and a background thread writes them with
+    COPY once batch_size rows are waiting or flush_interval seconds have passed.
+    Rows that can't be written are appended to a JSON-lines spill file, which is
+    replayed on the next start, and close() drains whatever is still queued. Rows
+    that can be neither written nor spilled stay in memory and are retried.
+    put() takes an optional callback, called once all its rows are committed or spilled.
+
+    `tables` maps a table name to (create_table_sql, column_names).
+    """
+
+    def __init__(self, connect, tables, batch_size=500, flush_interval=2.0, spill_path="server/db-spill.jsonl"):
+        self.connect = connect
+        self.tables = tables
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spill_path = spill_path
+
+        self.queue = queue.Queue()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.spill_lock = threading.Lock()
+        # Rows the thread could neither write nor spill when it stopped
+        self.unsaved = []
+
+    def start(self):
+        os.makedirs(os.path.dirname(self.spill_path) or ".", exist_ok=True)
+        self.replay_spill()
+        self.thread = threading.Thread(target=self.run, name="write-behind", daemon=True)
+        self.thread.start()
+
+    def put(self, table, rows, callback=None):
+        if table not in self.tables:
+            raise ValueError(f"Unknown table: {table}")
+        rows = [tuple(row) for row in rows]
+        if not rows:
+            if callback is not None:
+                callback()
+            return
+        done = countdown(len(rows), callback) if callback is not None else None
+        for row in rows:
+            self.queue.put((table, row, done))
+
+    def close(self):
+        """Stop the background thread and flush everything still queued."""
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        unsaved = self.flush(self.unsaved + self.drain())
+        if unsaved:
+            print(f"Write-behind lost {len(unsaved)} rows that could be neither written nor spilled")
+
+    def drain(self, limit=None):
+        batch = []
+        while limit is None or len(batch) < limit:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while not self.stopping.is_set():
+            try:
+                batch.append(self.queue.get(timeout=max(deadline - time.monotonic(), 0.01)))
+                batch.extend(self.drain(self.batch_size - len(batch)))
+            except queue.Empty:
+                pass
+
+            if len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                try:
+                    batch = self.flush(batch)
+                except Exception as e:
+                    # Keep the thread alive and the rows in memory for the next attempt
+                    print(f"Write-behind flush failed, keeping {len(batch)} rows for retry: {e}")
+                if batch:
+                    # Nothing could be saved; wait instead of retrying in a tight loop
+                    self.stopping.wait(self.flush_interval)
+                deadline = time.monotonic() + self.flush_interval
+
+        # close() flushes the rest after the thread has stopped
+        self.unsaved = batch
+
+    def flush(self, batch):
+        """Write a batch, spilling what can't be written.
+
+        Returns the entries that could be neither written nor spilled.
+        """
+        if not batch:
+            return []
+
+        by_table = {}
+        for entry in batch:
+            by_table.setdefault(entry[0], []).append(entry)
+
+        conn = None
+        failed = []
+        try:
+            conn = self.connect()
+            cur = conn.cursor()
+            for table, entries in by_table.items():
+                create_sql, columns = self.tables[table]
+                cur.execute(create_sql)
+                cur.execute("SAVEPOINT batch")
+                try:
+                    self.copy(cur, table, columns, [row for _, row, _ in entries])
+                except Exception as e:
+                    # One bad row fails the whole COPY; retry row by row and spill only the bad ones
+                    print(f"Batch COPY into {table} failed, retrying per row: {e}")
+                    cur.execute("ROLLBACK TO SAVEPOINT batch")
+                    for entry in entries:
+                        cur.execute("SAVEPOINT row")
+                        try:
+                            self.copy(cur, table, columns, [entry[1]])
+                        except Exception as e:
+                            cur.execute("ROLLBACK TO SAVEPOINT row")
+                            failed.append(entry)
+                            error = e
+            conn.commit()
+            cur.close()
+            print(f"Write-behind flushed {len(batch) - len(failed)} rows")
+        except Exception as e:
+            if conn is not None:
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+            # Nothing was committed, so the whole batch (bad rows included) is spilled once
+            unsaved = self.try_spill(batch, e)
+        else:
+            # Only now is it known that the other rows are in, so the bad ones can't be
+            # spilled a second time along with the whole batch
+            unsaved = self.try_spill(failed, error) if failed else []
+        finally:
+            if conn is not None:
+                conn.close()
+
+        unsaved_ids = {id(entry) for entry in unsaved}
+        for entry in batch:
+            done = entry[2]
+            if done is not None and id(entry) not in unsaved_ids:
+                try:
+                    done()
+                except Exception as e:
+                    print(f"Write-behind callback failed: {e}")
+        return unsaved
+
+    def try_spill(self, entries, error):
+        """Spill entries, returning the ones that couldn't be spilled either."""
+        try:
+            self.spill([(table, row) for table, row, _ in entries], error)
+        except OSError as e:
+            print(f"Could not spill {len(entries)} rows to {self.spill_path}, keeping them in memory: {e}")
+            return entries
+        return []
+
+    def copy(self, cur, table, columns, rows):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow([copy_value(v) for v in row])
+        buffer.seek(0)
+        cur.copy_expert(
+            f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')",
+            buffer,
+        )
+
+    def spill(self, batch, error):
+        print(f"Spilling {len(batch)} rows to {self.spill_path}: {error}")
+        with self.spill_lock:
+            with open(self.spill_path, "a", encoding="utf-8") as f:
+                for table, row in batch:
+                    f.write(json.dumps({"table": table, "row": list(row)}, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def replay_spill(self):
+        """Write the rows spilled by earlier failed flushes."""
+        replay_path = self.spill_path + ".replay"
+        with self.spill_lock:
+            # A .replay file left behind means an earlier replay was interrupted; keep both
+            if os.path.exists(self.spill_path):
+                with open(self.spill_path, encoding="utf-8") as src, open(replay_path, "a", encoding="utf-8") as dst:
+                    dst.write(src.read())
+                os.remove(self.spill_path)
+        if not os.path.exists(replay_path):
+            return
+
+        batch = []
+        with open(replay_path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    batch.append((record["table"], tuple(record["row"]), None))
+
+        print(f"Replaying {len(batch)} spilled rows")
+        # Rows that fail again go back into a fresh spill file; any that can't be
+        # spilled either are left in the replay file for the next start
+        unsaved = self.flush(batch)
+        if unsaved:
+            with open(replay_path + ".tmp", "w", encoding="utf-8") as f:
+                for table, row, _ in unsaved:
+                    f.write(json.dumps({"table": table, "row": list(row)}, ensure_ascii=False) + "\n")
+            os.replace(replay_path + ".tmp", replay_path)
+        else:
+            os.remove(replay_path)
@@ -0,0 +1,253 @@
+"""Compare OCR backends and DeepSeek resolution modes on a labeled receipt set.
+
+Each receipt is run through OCR and shipment extraction for every backend/mode,
+scored field by field against ground truth, and timed. The output is a
+Markdown table per configuration (like the comparison tables in the README)
+plus a summary with accuracy, latency and token counts, and the cheapest
+configuration that meets --accuracy-bar.
+
+Extraction calls are made without streaming (ollama_stream is forced off), so
+every call runs to completion and the token counts are Ollama's own
+prompt_eval_count and eval_count. A streamed call is cut off as soon as its
+JSON closes, before the final chunk that carries those counts.
+
+The dataset directory holds the images and a labels.json:
+
+    {
+      "receipt1.jpeg": {
+        "barcode": ["SPX123456789"],
+        "sender": "...",
+        "receiver": "...",
+        "sender_address": "...",
+        "receiver_address": "..."
+      }
+    }
+
+Usage:
+    uv run evaluate.py images/ --record fixtures/      # run the backends, save every run
+    uv run evaluate.py images/ --replay fixtures/      # re-score saved runs offline
+"""
+import argparse
+import json
+import os
+import re
+import time
+
+import server
+from tracing import start_trace
+
+FIELDS = ("barcode", "sender", "receiver", "sender_address", "receiver_address")
+HEADERS = ("Barcode", "Sender", "Receiver", "Sender Address", "Receiver Address")
+DEEPSEEK_MODES = ("tiny", "small", "base", "large", "gundam")
+
+
+def normalize(text):
+    return " ".join(re.sub(r"[^0-9a-z]+", " ", str(text or "").lower()).split())
+
+
+def text_matches(expected, predicted, threshold):
+    """Share of the expected words found in the prediction, compared to threshold."""
+    expected_words = normalize(expected).split()
+    predicted_words = set(normalize(predicted).split())
+    if not expected_words:
+        return not predicted_words
+    found = sum(word in predicted_words for word in expected_words)
+    return found / len(expected_words) >= threshold
+
+
+def barcodes_match(expected, predicted):
+    """Every expected barcode must appear among the predicted ones."""
+    clean = lambda code: re.sub(r"[^0-9A-Z]", "", str(code).upper())
+    predicted = {clean(code) for code in predicted or []}
+    return all(clean(code) in predicted for code in expected or [])
+
+
+def score(label, prediction, threshold):
+    return {
+        field: (
+            barcodes_match(label.get(field), prediction.get(field))
+            if field == "barcode"
+            else text_matches(label.get(field), prediction.get(field), threshold)
+        )
+        for field in FIELDS
+    }
+
+
+def prediction_from_items(items):
+    if isinstance(items, dict):
+        items = [items]
+    items = [item for item in items or [] if isinstance(item, dict)]
+    first = items[0] if items else {}
+    return {
+        "barcode": [code for item in items for code in item.get("BarcodeNumber") or []],
+        "sender": first.get("SenderName", ""),
+        "receiver": first.get("ReceiverName", ""),
+        "sender_address": first.get("SenderAddress", ""),
+        "receiver_address": first.get("ReceiverAddress", ""),
+    }
+
+
+def config_name(backend, mode):
+    return backend if mode is None else f"{backend}-{mode}"
+
+
+def run_receipt(backend, mode, image_bytes):
+    """Run OCR and shipment extraction once, returning what a fixture stores."""
+    with start_trace(enabled=True) as trace:
+        started = time.perf_counter()
+        if backend == "ollama_ocr":
+            content = server.ollama_ocr(image_bytes)
+        else:
+            content = server.deepseek_ocr(image_bytes, mode)
+        if content.startswith("An error occurred:"):
+            raise RuntimeError(content)
+        ocr_seconds = time.perf_counter() - started
+
+        raw = server.extract_shipment(content, "shipment")
+        total_seconds = time.perf_counter() - started
+
+    spans = trace.spans
+    return {
+        "ocr_text": content,
+        "extraction": raw,
+        "ocr_seconds": round(ocr_seconds, 3),
+        "total_seconds": round(total_seconds, 3),
+        "ocr_tokens": sum(s.get("eval_tokens", 0) for s in spans if s["name"].startswith("ocr.")),
+        "llm_tokens": sum(
+            s.get("prompt_tokens", 0) + s.get("eval_tokens", 0)
+            for s in spans
+            if s["name"] == "ollama.chat"
+        ),
+    }
+
+
+def load_run(args, backend, mode, receipt):
+    """Run a receipt live (optionally recording it) or load it from --replay."""
+    name = config_name(backend, mode)
+    if args.replay:
+        path = os.path.join(args.replay, name, receipt + ".json")
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+
+    with open(os.path.join(args.dataset, receipt), "rb") as f:
+        image_bytes = f.read()
+    started = time.perf_counter()
+    try:
+        run = run_receipt(backend, mode, image_bytes)
+    except Exception as e:
+        # Keep failed runs so they count against the configuration's accuracy
+        print(f"{name} failed on {receipt}: {e}")
+        run = {
+            "error": str(e),
+            "ocr_text": "",
+            "extraction": "",
+            "ocr_seconds": 0.0,
+            "total_seconds": round(time.perf_counter() - started, 3),
+            "ocr_tokens": 0,
+            "llm_tokens": 0,
+        }
+
+    if args.record:
+        os.makedirs(os.path.join(args.record, name), exist_ok=True)
+        with open(os.path.join(args.record, name, receipt + ".json"), "w", encoding="utf-8") as f:
+            json.dump(run, f, ensure_ascii=False, indent=2)
+    return run
+
+
+def markdown_table(name, rows):
+    lines = [
+        f"**OCR Model:** `{name}`",
+        "",
+        "| Receipt | " + " | ".join(HEADERS) + " | Latency (s) |",
+        "|---|" + "---|" * (len(HEADERS) + 1),
+    ]
+    for receipt, result, run in rows:
+        marks = " | ".join("✔" if result[field] else "❌" for field in FIELDS)
+        lines.append(f"| {receipt} | {marks} | {run['total_seconds']:.1f} |")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate OCR backends and DeepSeek modes on labeled receipts.")
+    parser.add_argument("dataset", help="directory with the receipt images and labels.json")
+    parser.add_argument("--backends", nargs="+", default=["ollama_ocr", "deepseek_ocr"],
+                        choices=["ollama_ocr", "deepseek_ocr"])
+    parser.add_argument("--modes", nargs="+", default=list(DEEPSEEK_MODES), choices=DEEPSEEK_MODES,
+                        help="DeepSeek resolution modes to try")
+    parser.add_argument("--match-threshold", type=float, default=0.8,
+                        help="share of expected words a text field must contain to count as correct")
+    parser.add_argument("--accuracy-bar", type=float, default=0.8,
+                        help="minimum field accuracy when picking the cheapest configuration")
+    recording = parser.add_mutually_exclusive_group()
+    recording.add_argument("--record", help="save every run to this fixtures directory")
+    recording.add_argument("--replay", help="score runs saved with --record instead of calling the backends")
+    args = parser.parse_args()
+
+    # Streamed calls stop before Ollama reports the token counts
+    server.ollama_stream = False
+
+    with open(os.path.join(args.dataset, "labels.json"), encoding="utf-8") as f:
+        labels = json.load(f)
+
+    configs = [
+        (backend, mode)
+        for backend in args.backends
+        for mode in (args.modes if backend == "deepseek_ocr" else [None])
+    ]
+
+    summary = []
+    for backend, mode in configs:
+        name = config_name(backend, mode)
+        rows = []
+        for receipt, label in labels.items():
+            run = load_run(args, backend, mode, receipt)
+            if run is None:
+                continue
+            # A failed parse scores as all-wrong
+            items = server.clean_and_validate_json(run["extraction"])
+            rows.append((receipt, score(label, prediction_from_items(items), args.match_threshold), run))
+
+        if not rows:
+            continue
+        print(markdown_table(name, rows))
+        print()
+
+        correct = sum(sum(result.values()) for _, result, _ in rows)
+        summary.append(
+            {
+                "name": name,
+                "receipts": len(rows),
+                "accuracy": correct / (len(rows) * len(FIELDS)),
+                "field_accuracy": {
+                    field: sum(result[field] for _, result, _ in rows) / len(rows) for field in FIELDS
+                },
+                "latency": sum(run["total_seconds"] for _, _, run in rows) / len(rows),
+                "ocr_latency": sum(run["ocr_seconds"] for _, _, run in rows) / len(rows),
+                "tokens": sum(run["ocr_tokens"] + run["llm_tokens"] for _, _, run in rows) / len(rows),
+            }
+        )
+
+    print("| Configuration | Receipts | " + " | ".join(HEADERS)
+          + " | Accuracy | Mean latency (s) | Mean OCR latency (s) | Mean tokens |")
+    print("|---|---|" + "---|" * (len(HEADERS) + 4))
+    for row in summary:
+        fields = " | ".join(f"{row['field_accuracy'][field]:.0%}" for field in FIELDS)
+        print(
+            f"| {row['name']} | {row['receipts']} | {fields} | {row['accuracy']:.0%} "
+            f"| {row['latency']:.1f} | {row['ocr_latency']:.1f} | {row['tokens']:.0f} |"
+        )
+
+    passing = [row for row in summary if row["accuracy"] >= args.accuracy_bar]
+    print()
+    if passing:
+        best = min(passing, key=lambda row: (row["latency"], row["tokens"]))
+        print(f"Cheapest configuration with accuracy >= {args.accuracy_bar:.0%}: "
+              f"{best['name']} ({best['accuracy']:.0%}, {best['latency']:.1f}s per receipt)")
+    else:
+        print(f"No configuration reaches {args.accuracy_bar:.0%} accuracy")
+
+
+if __name__ == "__main__":
+    main()
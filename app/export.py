@@ -0,0 +1,227 @@
+"""Stream invoice tables out of Postgres as CSV, JSONL or Parquet.
+
+Rows are read through a server-side cursor, chunk_size at a time, and each
+chunk is encoded and handed on before the next one is fetched, so memory use
+stays flat no matter how big the table is. The same generators back the
+GET /export/{table} endpoint and this CLI.
+
+Usage:
+    uv run export.py shipment_invoice --format parquet --output shipments.parquet --start 2025-10-01 --end 2025-11-01
+    uv run export.py non_shipment_invoice --format csv --category meal > meals.csv
+"""
+import argparse
+import csv
+import importlib.util
+import io
+import json
+import sys
+import uuid
+from datetime import date
+from decimal import Decimal
+
+TABLES = {
+    "shipment_invoice": {
+        "columns": ("id", "category", "delivery_company", "shipment_content", "quantity", "sender",
+                    "receiver", "sender_address", "receiver_address", "barcode", "created_at"),
+        "company": "delivery_company",
+    },
+    "non_shipment_invoice": {
+        "columns": ("id", "category", "name", "raw_data", "total_price", "sst", "service_charge",
+                    "created_at"),
+        "company": "name",
+    },
+}
+
+FORMATS = {
+    "csv": ("text/csv", ".csv"),
+    "jsonl": ("application/x-ndjson", ".jsonl"),
+    "parquet": ("application/vnd.apache.parquet", ".parquet"),
+}
+
+
+def build_query(table, start=None, end=None, category=None, company=None):
+    """SELECT for a table with optional filters; start is inclusive, end exclusive."""
+    if table not in TABLES:
+        raise ValueError(f"Unknown table {table!r}, expected one of {list(TABLES)}")
+
+    conditions, params = [], []
+    if start is not None:
+        conditions.append("created_at >= %s")
+        params.append(start)
+    if end is not None:
+        conditions.append("created_at < %s")
+        params.append(end)
+    if category:
+        conditions.append("category = %s")
+        params.append(category)
+    if company:
+        conditions.append(f"{TABLES[table]['company']} ILIKE %s")
+        params.append(company)
+
+    sql = f"SELECT {', '.join(TABLES[table]['columns'])} FROM {table}"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    return sql + " ORDER BY id", params
+
+
+def fetch_chunks(connect, table, filters, chunk_size=5000):
+    """Yield lists of rows from a server-side (named) cursor."""
+    sql, params = build_query(table, **filters)
+    conn = connect()
+    try:
+        # A named cursor keeps the result set on the server instead of loading it all
+        cur = conn.cursor(name=f"export_{uuid.uuid4().hex}")
+        cur.itersize = chunk_size
+        cur.execute(sql, params)
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+        cur.close()
+    finally:
+        conn.close()
+
+
+def plain(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return value
+
+
+def csv_chunks(columns, chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for rows in chunks:
+        for row in rows:
+            # Arrays are written as JSON lists so they survive the round trip
+            writer.writerow(
+                json.dumps(v, ensure_ascii=False) if isinstance(v, list) else plain(v) for v in row
+            )
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+def jsonl_chunks(columns, chunks):
+    for rows in chunks:
+        yield "".join(
+            json.dumps({c: plain(v) for c, v in zip(columns, row)}, ensure_ascii=False) + "\n"
+            for row in rows
+        ).encode("utf-8")
+
+
+class DrainableSink:
+    """Write-only file object whose contents can be taken out as they are written."""
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.buffer.write(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return data
+
+
+def parquet_schema(columns):
+    import pyarrow as pa
+
+    types = {
+        "id": pa.int64(),
+        "quantity": pa.float64(),
+        "barcode": pa.list_(pa.string()),
+        "created_at": pa.timestamp("us", tz="UTC"),
+    }
+    return pa.schema([(c, types.get(c, pa.string())) for c in columns])
+
+
+def require_pyarrow():
+    if importlib.util.find_spec("pyarrow") is None:
+        raise RuntimeError("Parquet export needs pyarrow: uv pip install pyarrow")
+
+
+def parquet_chunks(columns, chunks):
+    """One Parquet row group per chunk, streamed out as soon as it is written."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = parquet_schema(columns)
+    sink = DrainableSink()
+    writer = pq.ParquetWriter(pa.PythonFile(sink, mode="w"), schema)
+    for rows in chunks:
+        data = {
+            c: [float(v) if isinstance(v, Decimal) else v for v in values]
+            for c, values in zip(columns, zip(*rows))
+        }
+        writer.write_table(pa.Table.from_pydict(data, schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+ENCODERS = {"csv": csv_chunks, "jsonl": jsonl_chunks, "parquet": parquet_chunks}
+
+
+def export(connect, table, fmt, filters, chunk_size=5000):
+    """Return a generator of the encoded export as byte chunks."""
+    if fmt not in ENCODERS:
+        raise ValueError(f"Unknown format {fmt!r}, expected one of {list(ENCODERS)}")
+    # Fail before the first chunk is requested, while an error can still be reported
+    build_query(table, **filters)
+    if fmt == "parquet":
+        require_pyarrow()
+    return ENCODERS[fmt](TABLES[table]["columns"], fetch_chunks(connect, table, filters, chunk_size))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export invoices as CSV, JSONL or Parquet.")
+    parser.add_argument("table", choices=list(TABLES))
+    parser.add_argument("--format", choices=list(FORMATS), default="csv")
+    parser.add_argument("--output", "-o", default="-", help="output file, - for stdout")
+    parser.add_argument("--start", type=date.fromisoformat, help="created on or after (YYYY-MM-DD)")
+    parser.add_argument("--end", type=date.fromisoformat, help="created before (YYYY-MM-DD)")
+    parser.add_argument("--category", help="exact category, e.g. meal")
+    parser.add_argument("--company", help="delivery company (shipments) or store name, ILIKE pattern")
+    parser.add_argument("--chunk-size", type=int, default=5000, help="rows fetched per round trip")
+    args = parser.parse_args()
+
+    # Read-only: no migrations here, since DDL would lock the tables for the whole export
+    from db import connect_db
+
+    filters = dict(start=args.start, end=args.end, category=args.category, company=args.company)
+    chunks = export(connect_db, args.table, args.format, filters, args.chunk_size)
+    if args.output == "-":
+        out = sys.stdout.buffer
+        for chunk in chunks:
+            out.write(chunk)
+        out.flush()
+    else:
+        with open(args.output, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+
+
+if __name__ == "__main__":
+    main()
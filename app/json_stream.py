@@ -0,0 +1,151 @@
+class StreamAbort(Exception):
+    """Raised when a streamed generation can no longer turn into valid JSON."""
+
+
+class JsonStreamScanner:
+    """Incrementally scan streamed LLM output for a single top-level JSON value.
+
+    Tracks string/escape state and bracket depth so the caller knows the moment
+    the top-level value closes, and raises StreamAbort as soon as the output is
+    clearly not going to parse:
+    - too much prose before the JSON starts (<think> blocks and ``` fences are allowed)
+    - runaway repetition of a short pattern at the end of the output, not counting
+      complete JSON elements (a list of identical items is valid output)
+
+    All state is updated as characters arrive, so each character is only looked
+    at once and the cost stays linear in the length of the output.
+    """
+
+    # A repeated run has to be longer than the largest column (raw_data, 5000 chars),
+    # since receipts (and OCR output) legitimately repeat the same line many times
+    def __init__(self, max_preamble=200, repeat_chars=6000, max_period=200, check_every=1000):
+        self.max_preamble = max_preamble
+        self.repeat_chars = repeat_chars
+        self.max_period = max_period
+        self.check_every = check_every
+
+        self.parts = []
+        self.length = 0
+        # The last 2 * repeat_chars characters, for the repetition check
+        self.tail = ""
+        self.start = None
+        self.end = None
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.balanced_to = 0
+        self.checked_at = 0
+        # Preamble state: the last few characters (to match tags and fences), inside
+        # a <think> block, end of the last ``` fence (and of its optional "json"), and
+        # the count of non-whitespace characters outside both
+        self.window = ""
+        self.in_think = False
+        self.backticks_end = -1
+        self.fence_end = 0
+        self.prose = 0
+
+    @property
+    def closed(self):
+        return self.end is not None
+
+    @property
+    def text(self):
+        return "".join(self.parts)
+
+    @property
+    def json_text(self):
+        if self.start is None:
+            return None
+        return self.text[self.start:self.end]
+
+    def feed(self, chunk):
+        """Consume a chunk of output. Returns True once the top-level value has closed."""
+        if self.closed:
+            return True
+
+        offset = self.length
+        for i, c in enumerate(chunk, offset):
+            if self.start is None:
+                if c in "{[" and not self.in_think:
+                    self.start = i
+                    self.depth = 1
+                else:
+                    self.scan_preamble(i, c)
+                continue
+
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif c == "\\":
+                    self.escape = True
+                elif c == '"':
+                    self.in_string = False
+            elif c == '"':
+                self.in_string = True
+            elif c in "{[":
+                self.depth += 1
+            elif c == ",":
+                self.balanced_to = i + 1
+            elif c in "}]":
+                self.depth -= 1
+                self.balanced_to = i + 1
+                if self.depth == 0:
+                    self.end = i + 1
+                    self.parts.append(chunk[:self.end - offset])
+                    self.length = self.end
+                    return True
+
+        self.parts.append(chunk)
+        self.length += len(chunk)
+        self.tail = (self.tail + chunk)[-2 * self.repeat_chars:]
+
+        if self.start is None and self.prose > self.max_preamble:
+            raise StreamAbort("prose before JSON")
+
+        if self.length - self.checked_at >= self.check_every:
+            self.checked_at = self.length
+            if self.repeating():
+                raise StreamAbort("runaway repetition")
+
+        return False
+
+    def scan_preamble(self, i, c):
+        """Update the <think>/fence state and prose count for character i before the JSON."""
+        self.window = self.window[-7:] + c
+        if self.in_think:
+            if self.window.endswith("</think>"):
+                self.in_think = False
+            return
+
+        if not c.isspace():
+            self.prose += 1
+        # Tags and fences are only recognised on their last character, so take back
+        # the characters already counted as prose
+        if self.window.endswith("<think>"):
+            self.in_think = True
+            self.prose -= len("<think>")
+        elif i - 2 >= self.fence_end and self.window.endswith("```"):
+            self.backticks_end = self.fence_end = i + 1
+            self.prose -= len("```")
+        elif self.backticks_end == i - 3 and self.window[-4:].lower() == "json":
+            self.fence_end = i + 1
+            self.prose -= len("json")
+
+    def repeating(self):
+        """True when the tail of the output is one short pattern repeated over and over.
+
+        Only text after the last complete JSON element (the last structural comma or
+        closing bracket) is checked, so a long run of identical elements doesn't
+        count, but a string that keeps repeating itself does.
+        """
+        tail = self.tail[max(self.balanced_to - (self.length - len(self.tail)), 0):]
+        for period in range(1, self.max_period + 1):
+            times = max(4, -(-self.repeat_chars // period))
+            if period * times > len(tail):
+                continue
+            # Cheap check on the last two periods before comparing the whole run
+            if tail[-period:] != tail[-2 * period:-period]:
+                continue
+            if tail[-period * times:] == tail[-period:] * times:
+                return True
+        return False
@@ -0,0 +1,120 @@
+import io
+import threading
+from collections import OrderedDict
+from itertools import combinations
+
+import numpy as np
+
+HASH_SIZE = 8
+
+
+def grayscale(image_bytes, size):
+    """Decode an image and downscale it to a (height, width) grayscale float array."""
+    from PIL import Image
+
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        small = image.convert("L").resize((size[1], size[0]), Image.LANCZOS)
+    return np.asarray(small, dtype=np.float64)
+
+
+def pack_bits(bits):
+    return int("".join("1" if b else "0" for b in bits.flatten()), 2)
+
+
+def dhash(image_bytes):
+    """Difference hash: is each pixel brighter than its right neighbour?"""
+    pixels = grayscale(image_bytes, (HASH_SIZE, HASH_SIZE + 1))
+    return pack_bits(pixels[:, 1:] > pixels[:, :-1])
+
+
+def dct_matrix(n):
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+DCT_32 = dct_matrix(4 * HASH_SIZE)
+
+
+def phash(image_bytes):
+    """Perceptual hash: low-frequency DCT coefficients compared to their median."""
+    pixels = grayscale(image_bytes, (4 * HASH_SIZE, 4 * HASH_SIZE))
+    low = (DCT_32 @ pixels @ DCT_32.T)[:HASH_SIZE, :HASH_SIZE]
+    # The DC term only reflects overall brightness, so leave it out of the median
+    return pack_bits(low > np.median(low.flatten()[1:]))
+
+
+HASHES = {"phash": phash, "dhash": dhash}
+
+
+class NearDuplicateIndex:
+    """Hamming-distance index over the 64-bit hashes of recently processed images.
+
+    Uses multi-index hashing: the hash is split into `chunks` parts, and two
+    hashes within max_distance of each other must have at least one part within
+    max_distance // chunks. A lookup only probes the buckets of each part that
+    are that close, instead of comparing against every entry, so it stays fast
+    with millions of entries. The oldest entries are evicted beyond `capacity`.
+    """
+
+    def __init__(self, max_distance=6, chunks=4, capacity=100_000, bits=64):
+        self.max_distance = max_distance
+        self.chunks = chunks
+        self.capacity = capacity
+        self.chunk_bits = bits // chunks
+        self.chunk_mask = (1 << self.chunk_bits) - 1
+        self.radius = max_distance // chunks
+        # XOR masks that flip up to `radius` bits of a chunk
+        self.probes = [
+            sum(1 << bit for bit in flipped)
+            for r in range(self.radius + 1)
+            for flipped in combinations(range(self.chunk_bits), r)
+        ]
+
+        self.tables = [{} for _ in range(chunks)]
+        self.entries = OrderedDict()
+        self.next_id = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def parts(self, value):
+        return [(value >> (i * self.chunk_bits)) & self.chunk_mask for i in range(self.chunks)]
+
+    def add(self, value, payload):
+        with self.lock:
+            entry_id = self.next_id
+            self.next_id += 1
+            self.entries[entry_id] = (value, payload)
+            for table, part in zip(self.tables, self.parts(value)):
+                table.setdefault(part, set()).add(entry_id)
+
+            while len(self.entries) > self.capacity:
+                old_id, (old_value, _) = self.entries.popitem(last=False)
+                for table, part in zip(self.tables, self.parts(old_value)):
+                    bucket = table[part]
+                    bucket.discard(old_id)
+                    if not bucket:
+                        del table[part]
+            return entry_id
+
+    def lookup(self, value):
+        """Return (distance, payload) of the closest entry within max_distance, or None."""
+        with self.lock:
+            candidates = set()
+            for table, part in zip(self.tables, self.parts(value)):
+                for probe in self.probes:
+                    bucket = table.get(part ^ probe)
+                    if bucket:
+                        candidates |= bucket
+
+            best = None
+            for entry_id in candidates:
+                other, payload = self.entries[entry_id]
+                distance = (value ^ other).bit_count()
+                if distance <= self.max_distance and (best is None or distance < best[0]):
+                    best = (distance, payload)
+            return best
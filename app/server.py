@@ -1,9 +1,8 @@
 import ollama
-import psycopg2
 from psycopg2 import Error
 import json
-from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, UploadFile, File, HTTPException, Header, Request
+from fastapi.responses import JSONResponse, StreamingResponse
 import uvicorn
 import requests
 import base64
@@ -11,16 +10,61 @@ import tempfile
 from dotenv import load_dotenv
 import os
 import re
+import copy
+import threading
+import time
+import hmac
+import uuid
+import contextvars
+from datetime import date
+from concurrent.futures import ThreadPoolExecutor
+from json_stream import JsonStreamScanner, StreamAbort
+from db import NON_SHIPMENT_TABLE, SHIPMENT_TABLE, connect_db, migrate_db
+from db_writer import WriteBehindWriter
+from tracing import Profiler, parse_server_timing, span, start_trace, trace_id, traced
+from phash import HASHES, NearDuplicateIndex
+from export import FORMATS as EXPORT_FORMATS, TABLES as EXPORT_TABLES, export
 
 # Load .env file
 load_dotenv()
 
-# Access environment variables
-database = os.getenv("database")
-user = os.getenv("user")
-password = os.getenv("password")
+# DeepSeek OCR resolution mode: tiny, small, base, large or gundam
+deepseek_mode = os.getenv("deepseek_mode", "gundam")
+
+# Ollama chat calls stream and stop as soon as the JSON answer closes
+ollama_stream = os.getenv("ollama_stream", "true").lower() == "true"
+ollama_stream_retries = int(os.getenv("ollama_stream_retries", "1"))
+
+# Keep the models loaded in Ollama; warm_interval (seconds) re-warms them periodically, 0 disables
+ollama_keep_alive = os.getenv("ollama_keep_alive", "30m")
+warm_interval = int(os.getenv("warm_interval", "600"))
+
+# Write-behind DB writer: flush every write_behind_batch rows or write_behind_interval seconds
+write_behind = os.getenv("write_behind", "false").lower() == "true"
+write_behind_batch = int(os.getenv("write_behind_batch", "500"))
+write_behind_interval = float(os.getenv("write_behind_interval", "2"))
+write_behind_spill = os.getenv("write_behind_spill", "server/db-spill.jsonl")
+
+# Speculative extraction: start the likelier summarize call while categorize runs
+speculative = os.getenv("speculative", "false").lower() == "true"
+speculative_max_inflight = int(os.getenv("speculative_max_inflight", "2"))
+# Requests Ollama runs in parallel per model; set to the server's OLLAMA_NUM_PARALLEL
+ollama_num_parallel = int(os.getenv("ollama_num_parallel", os.getenv("OLLAMA_NUM_PARALLEL", "4")))
+
+# Near-duplicate images: "flag" skips them, "cache" returns the earlier extraction, "off" disables
+dedup_mode = os.getenv("dedup_mode", "off")
+dedup_hash = os.getenv("dedup_hash", "phash")
+dedup_max_distance = int(os.getenv("dedup_max_distance", "6"))
+dedup_capacity = int(os.getenv("dedup_capacity", "100000"))
+# Skipped uploads are logged (and kept) here so false positives can be reviewed
+dedup_flagged_dir = os.getenv("dedup_flagged_dir", "server/flagged-duplicates")
+
+# Per-request span timings in the logs; admin_token guards the /admin endpoints
+tracing = os.getenv("tracing", "false").lower() == "true"
+admin_token = os.getenv("admin_token")
 
 app = FastAPI()
+profiler = Profiler()
 
 
 def ollama_ocr(image_bytes: bytes):
@@ -37,17 +81,23 @@ def ollama_ocr(image_bytes: bytes):
                 }
             ],
             "stream": False,
+            "keep_alive": ollama_keep_alive,
         }
 
         # Send POST request to Ollama HTTP API
-        response = requests.post(
-            "http://localhost:11434/api/chat", json=payload
-        )
+        with span("ocr.ollama", model="qwen2.5vl:7b") as attrs:
+            response = requests.post(
+                "http://localhost:11434/api/chat", json=payload
+            )
 
-        if response.status_code != 200:
-            raise RuntimeError(f"API error: {response.text}")
+            if response.status_code != 200:
+                raise RuntimeError(f"API error: {response.text}")
 
-        result = response.json()["message"]["content"]
+            data = response.json()
+            attrs["prompt_tokens"] = data.get("prompt_eval_count", 0)
+            attrs["eval_tokens"] = data.get("eval_count", 0)
+
+        result = data["message"]["content"]
 
         with open(f"server/text.txt", "w", encoding="utf-8") as f:
             f.write(result)
@@ -57,7 +107,7 @@ def ollama_ocr(image_bytes: bytes):
     except Exception as e:
         return f"An error occurred: {e}"
     
-def deepseek_ocr(image_bytes: bytes):
+def deepseek_ocr(image_bytes: bytes, mode=None):
     try:
         # Save the image bytes to a temporary file
         with tempfile.NamedTemporaryFile(suffix=".jpeg", delete=False) as tmp:
@@ -65,15 +115,25 @@ def deepseek_ocr(image_bytes: bytes):
             tmp_path = tmp.name
 
         # Prepare multipart/form-data payload
-        with open(tmp_path, "rb") as f:
-            files = {"image": f}
-            response = requests.post("http://localhost:4896/deepseek", files=files)
-
-        if response.status_code != 200:
-            raise RuntimeError(f"Server error: {response.text}")
-
-        # Parse the FastAPI server’s JSON response
-        result = response.json().get("result", "")
+        with span("ocr.deepseek", mode=mode or deepseek_mode) as attrs:
+            with open(tmp_path, "rb") as f:
+                files = {"image": f}
+                response = requests.post(
+                    "http://localhost:4896/deepseek",
+                    files=files,
+                    data={"mode": mode or deepseek_mode},
+                    headers={"X-Trace-Id": trace_id() or ""},
+                )
+            # Stage timings reported by the OCR server
+            attrs.update(parse_server_timing(response.headers.get("Server-Timing", "")))
+
+            if response.status_code != 200:
+                raise RuntimeError(f"Server error: {response.text}")
+
+            # Parse the FastAPI server’s JSON response
+            data = response.json()
+            attrs["eval_tokens"] = data.get("tokens", 0)
+        result = data.get("result", "")
 
         # Optionally save output to file
         with open("server/text.txt", "w", encoding="utf-8") as f:
@@ -84,13 +144,113 @@ def deepseek_ocr(image_bytes: bytes):
     except Exception as e:
         return f"An error occurred: {e}"
     
-def categorize(content):
-    payload = {
-        "model": "qwen3:8b",
-        "messages": [
-            {
-                "role": "system",
-                "content": """
+STRICT_JSON_RETRY = """
+Your previous reply was rejected ({reason}).
+Reply with the JSON value only: start directly with '{{' or '[' and write nothing after it closes.
+"""
+
+
+# Chat calls currently running against Ollama, from every thread, so speculation
+# can back off when the backend is busy
+ollama_inflight = 0
+ollama_inflight_lock = threading.Lock()
+
+
+def ollama_chat(payload, cancel=None):
+    """Send a chat request to Ollama and return the message content.
+
+    The response is streamed through JsonStreamScanner: generation is cut off as
+    soon as the top-level JSON value closes, and aborted early when the output
+    clearly won't parse (prose before the JSON, runaway repetition), in which
+    case the request is retried with a stricter prompt. Setting `cancel`
+    (a threading.Event) drops the connection, which stops generation in Ollama.
+    """
+    global ollama_inflight
+    with ollama_inflight_lock:
+        ollama_inflight += 1
+    try:
+        return send_chat(payload, cancel)
+    finally:
+        with ollama_inflight_lock:
+            ollama_inflight -= 1
+
+
+def send_chat(payload, cancel=None):
+    if not ollama_stream:
+        with span("ollama.chat", model=payload["model"]) as attrs:
+            response = requests.post(
+                "http://localhost:11434/api/chat",
+                json=dict(payload, stream=False, keep_alive=ollama_keep_alive),
+            )
+            if response.status_code != 200:
+                raise RuntimeError(f"API error: {response.text}")
+            data = response.json()
+            attrs["prompt_tokens"] = data.get("prompt_eval_count", 0)
+            attrs["eval_tokens"] = data.get("eval_count", 0)
+        return data["message"]["content"]
+
+    for attempt in range(ollama_stream_retries + 1):
+        try:
+            with span("ollama.chat", model=payload["model"], attempt=attempt + 1) as attrs:
+                return stream_chat(payload, cancel, attrs)
+        except StreamAbort as e:
+            print(f"Aborted Ollama generation (attempt {attempt + 1}): {e}")
+            reason = str(e)
+            payload = tighten_prompt(payload, reason)
+
+    raise RuntimeError(f"Ollama output is not valid JSON: {reason}")
+
+
+def stream_chat(payload, cancel=None, stats=None):
+    scanner = JsonStreamScanner()
+    stats = {} if stats is None else stats
+    stats["eval_tokens"] = 0
+    with requests.post(
+        "http://localhost:11434/api/chat",
+        json=dict(payload, stream=True, keep_alive=ollama_keep_alive),
+        stream=True,
+    ) as response:
+        if response.status_code != 200:
+            raise RuntimeError(f"API error: {response.text}")
+
+        for line in response.iter_lines():
+            if cancel is not None and cancel.is_set():
+                raise RuntimeError("Ollama generation cancelled")
+            if not line:
+                continue
+            chunk = json.loads(line)
+            if "error" in chunk:
+                raise RuntimeError(f"API error: {chunk['error']}")
+            # Only the final "done" chunk carries the real counts, and it never arrives
+            # when the stream is cut off early, so eval_tokens is then just the number
+            # of chunks received and prompt_tokens is missing
+            stats["eval_tokens"] = chunk.get("eval_count", stats["eval_tokens"] + 1)
+            if "prompt_eval_count" in chunk:
+                stats["prompt_tokens"] = chunk["prompt_eval_count"]
+            # Closing the response here stops generation in Ollama
+            if scanner.feed(chunk.get("message", {}).get("content", "")):
+                return scanner.json_text
+            if chunk.get("done"):
+                break
+
+    return scanner.text
+
+
+def tighten_prompt(payload, reason):
+    payload = copy.deepcopy(payload)
+    messages = payload["messages"]
+    instruction = STRICT_JSON_RETRY.format(reason=reason)
+    if messages and messages[0]["role"] == "system":
+        messages[0]["content"] += instruction
+    else:
+        messages.insert(0, {"role": "system", "content": instruction})
+    payload["options"] = dict(payload.get("options", {}), temperature=0)
+    return payload
+
+
+# The system prompts below are kept static (no per-request content) so every request
+# shares a byte-identical prefix that Ollama can reuse from its KV cache.
+CATEGORIZE_PROMPT = """
                 You are a categorizer that help to categorize invoice into different category, the category include shipment invoice and non shipment invoice.
                 If there is shipping address means that it is shipment. 
 
@@ -106,7 +266,70 @@ def categorize(content):
                 - only return category in json format:
                 {"<shipment or non shipment>":"<category>"}
 
-                """,
+                """
+
+SHIPMENT_PROMPT = """You are a data extraction assistant that returns structured JSON only.
+
+                    Extract the following details from the receipt provided and return ONLY in JSON format:
+
+                    Expected JSON structure (array of objects):
+                    [
+                    {
+                        "Category" : "string",
+                        "DeliveryCompany": "string",
+                        "ShipmentContent": "string",
+                        "Quantity": integer,
+                        "SenderName": "string",
+                        "ReceiverName": "string",
+                        "SenderAddress": "string",
+                        "ReceiverAddress": "string",
+                        "BarcodeNumber": ["string", "string", ...]  // all barcodes for this shipment go into this list
+                    }
+                    ]
+
+                    Input the category given after the receipt into the json.
+
+                    Rules:
+                    - BarcodeNumber is order number/ shipping number. If found order number and shipping number add them both to BarcodeNumber.
+                    - If multiple shipment contents exist, repeat the delivery company, sender, and receiver for each.
+                    - If a shipment has multiple barcodes, put all barcode numbers in the **BarcodeNumber** list inside the same object.
+                    - Do not include any text outside of JSON.
+                    - Ensure valid JSON syntax.
+                    """
+
+NON_SHIPMENT_PROMPT = """You are a data extraction assistant that returns structured JSON only.
+                    
+                    Extract the content provided and return ONLY in JSON format:
+
+                    Expected JSON structure (array of objects):
+                    [
+                        {
+                            "Category": "string",
+                            "Name": "string",  // name of the store
+                            "Raw_data": "string" // all raw data from the receipt
+                            "Total_Price": "string", // total price for all items
+                            "SST": "string", // government tax
+                            "Service_Charge" : "string" //service charge
+                        }
+                    ]
+
+                    Input the category given after the receipt into the json.
+
+                    Rules:
+                    - You MUST follow exactly like the expected JSON structure
+                    - If there are no barcodes, set "BarcodeNumber": [] (do NOT omit this key).
+                    - Do not include any explanations, comments, or text before or after the JSON.
+                """
+
+
+@traced("categorize")
+def categorize(content):
+    payload = {
+        "model": "qwen3:8b",
+        "messages": [
+            {
+                "role": "system",
+                "content": CATEGORIZE_PROMPT,
             },
             {
                 "role": "user",
@@ -117,77 +340,38 @@ def categorize(content):
     }
 
     # Send HTTP request to Ollama
-    response2 = requests.post(
-        "http://localhost:11434/api/chat", json=payload
-    )
-
-    # Convert HTTP response body (bytes) to Python dict
-    data2 = response2.json()
-
-    # Now safely extract the message content
-    content2 = data2["message"]["content"]
+    content2 = ollama_chat(payload)
 
 
     return content2
 
 
 
-def summarize_shipment(content,category):
+@traced("extract.shipment")
+def extract_shipment(content,category,cancel=None):
 
     payload = {
         "model": "qwen3:8b",
         "messages": [
             {
                 "role": "system",
-                "content": "You are a data extraction assistant that returns structured JSON only.",
+                "content": SHIPMENT_PROMPT,
             },
             {
                 "role": "user",
-                "content": f"""
-                    {content}
-
-                    Extract the following details and return ONLY in JSON format:
-
-                    Expected JSON structure (array of objects):
-                    [
-                    {{
-                        "Category" : "string",
-                        "DeliveryCompany": "string",
-                        "ShipmentContent": "string",
-                        "Quantity": integer,
-                        "SenderName": "string",
-                        "ReceiverName": "string",
-                        "SenderAddress": "string",
-                        "ReceiverAddress": "string",
-                        "BarcodeNumber": ["string", "string", ...]  // all barcodes for this shipment go into this list
-                    }}
-                    ]
-
-                    Input the category into the json: {category}
-
-                    Rules:
-                    - BarcodeNumber is order number/ shipping number. If found order number and shipping number add them both to BarcodeNumber.
-                    - If multiple shipment contents exist, repeat the delivery company, sender, and receiver for each.
-                    - If a shipment has multiple barcodes, put all barcode numbers in the **BarcodeNumber** list inside the same object.
-                    - Do not include any text outside of JSON.
-                    - Ensure valid JSON syntax.
-                    
-                    """,
+                "content": f"{content}\n\nCategory: {category}",
             },
         ],
         "stream": False,
     }
 
     # Send HTTP request to Ollama
-    response3 = requests.post(
-        "http://localhost:11434/api/chat", json=payload
-    )
+    content3 = ollama_chat(payload, cancel=cancel)
 
-    # Convert HTTP response body (bytes) to Python dict
-    data3 = response3.json()
+    return content3
 
-    # Now safely extract the message content
-    content3 = data3["message"]["content"]
+def summarize_shipment(content,category):
+    content3 = extract_shipment(content,category)
 
     # Write to file
     with open("server/shipment-summary.json", "w", encoding="utf-8") as f:
@@ -195,6 +379,7 @@ def summarize_shipment(content,category):
 
     return content3
 
+@traced("json_cleanup")
 def clean_and_validate_json(raw_text: str):
     # 1. Remove Markdown code fences
     text = re.sub(r"^```(?:json)?\s*", "", raw_text.strip())
@@ -214,57 +399,32 @@ def clean_and_validate_json(raw_text: str):
         print("Raw text:\n", raw_text[:500])
         return None
 
-def summarize_non_shipment(content,category):
+@traced("extract.non_shipment")
+def extract_non_shipment(content,category,cancel=None):
 
     payload = {
         "model": "qwen3:8b",
         "messages": [
             {
                 "role": "system",
-                "content": f"""You are a data extraction assistant that returns structured JSON only.
-                    
-                    Extract the content provided and return ONLY in JSON format:
-
-                    Expected JSON structure (array of objects):
-                    [
-                        {{
-                            "Category": "string",
-                            "Name": "string",  // name of the store
-                            "Raw_data": "string" // all raw data from the receipt
-                            "Total_Price": "string", // total price for all items
-                            "SST": "string", // government tax
-                            "Service_Charge" : "string" //service charge
-                        }}
-                    ]
-
-                    Input the category into the json: {category}
-
-                    Rules:
-                    - You MUST follow exactly like the expected JSON structure
-                    - If there are no barcodes, set "BarcodeNumber": [] (do NOT omit this key).
-                    - Do not include any explanations, comments, or text before or after the JSON.
-                """,
+                "content": NON_SHIPMENT_PROMPT,
             },
             {
                 "role": "user",
-                "content": f"{content}",
+                "content": f"{content}\n\nCategory: {category}",
             },
         ],
         "stream": False,
     }
 
-        # Send HTTP request to Ollama
-    response4 = requests.post(
-        "http://localhost:11434/api/chat", json=payload
-    )
+    # Send HTTP request to Ollama
+    content4 = ollama_chat(payload, cancel=cancel)
 
-    # Convert HTTP response body (bytes) to Python dict
-    data4 = response4.json()
+    return content4
 
-    # Now safely extract the message content
-    content4 = data4["message"]["content"]
+def summarize_non_shipment(content,category):
+    content4 = extract_non_shipment(content,category)
 
-    
     parsed_json = clean_and_validate_json(content4)
     print(parsed_json)
 
@@ -278,10 +438,74 @@ def summarize_non_shipment(content,category):
 
 
 
-def store_shipment_data():
+def shipment_row(item):
+    return (
+        item["Category"],
+        item["DeliveryCompany"],
+        item["ShipmentContent"],
+        item["Quantity"],
+        item["SenderName"],
+        item["ReceiverName"],
+        item.get("SenderAddress", ""),  # optional fallback
+        item.get("ReceiverAddress", ""),
+        item.get("BarcodeNumber", []),
+    )
+
+
+def non_shipment_row(item):
+    return (
+        item["Category"],
+        item["Name"],
+        item["Raw_data"],
+        item["Total_Price"],
+        item["SST"],
+        item["Service_Charge"],
+    )
+
+
+# Write-behind: rows are queued in-process and COPY'd in batches by a background thread
+def make_db_writer():
+    return WriteBehindWriter(
+        connect_db,
+        {
+            "shipment_invoice": (
+                SHIPMENT_TABLE,
+                ("category", "delivery_company", "shipment_content", "quantity", "sender",
+                 "receiver", "sender_address", "receiver_address", "barcode"),
+            ),
+            "non_shipment_invoice": (
+                NON_SHIPMENT_TABLE,
+                ("category", "name", "raw_data", "total_price", "SST", "Service_Charge"),
+            ),
+        },
+        batch_size=write_behind_batch,
+        flush_interval=write_behind_interval,
+        spill_path=write_behind_spill,
+    )
+
+
+db_writer = make_db_writer() if write_behind else None
+
+
+@app.on_event("startup")
+def start_db_writer():
+    migrate_db()
+    if db_writer is not None:
+        db_writer.start()
+
+
+@app.on_event("shutdown")
+def drain_db_writer():
+    if db_writer is not None:
+        db_writer.close()
+
+
+@traced("db.insert")
+def store_shipment_data(items=None, on_stored=None):
     # Load JSON file
-    with open("server/shipment-summary.json") as f:
-        items = json.load(f)
+    if items is None:
+        with open("server/shipment-summary.json") as f:
+            items = json.load(f)
     """
     Store data into database
 
@@ -292,35 +516,33 @@ def store_shipment_data():
     sender (str): the sender of the item
     receiver (str): the receiver of the item
     """
+    if not items:
+        return ("Error occurred:", "Extraction returned no items")
+    if db_writer is not None:
+        # on_stored runs on the writer thread, once the rows are flushed or spilled
+        db_writer.put("shipment_invoice", [shipment_row(item) for item in items], on_stored)
+        item = items[-1]
+        return (
+            "Queued for write-behind insert",
+            item["Category"],
+            item["DeliveryCompany"],
+            item["ShipmentContent"],
+            item["Quantity"],
+            item["SenderName"],
+            item["ReceiverName"],
+            item.get("SenderAddress", ""),
+            item.get("ReceiverAddress", ""),
+            item.get("BarcodeNumber", []),
+        )
+
     # Connect to PostgreSQL
     try:
-        conn = psycopg2.connect(
-            dbname=database,
-            user=user,
-            password=password,
-            host="localhost",
-            port="5432",
-        )
+        conn = connect_db()
 
         # Create a cursor
         cur = conn.cursor()
 
-        cur.execute(
-            """
-        CREATE TABLE IF NOT EXISTS shipment_invoice (
-            id SERIAL PRIMARY KEY,
-            category VARCHAR(100),
-            delivery_company VARCHAR(100),
-            shipment_content VARCHAR(300),
-            quantity NUMERIC,
-            sender VARCHAR(100),
-            receiver VARCHAR(100),
-            sender_address VARCHAR(300),
-            receiver_address VARCHAR(300),
-            barcode TEXT[] 
-        )
-        """
-        )
+        cur.execute(SHIPMENT_TABLE)
 
         for item in items:
 
@@ -329,20 +551,12 @@ def store_shipment_data():
             INSERT INTO shipment_invoice (category,delivery_company, shipment_content,quantity,sender,receiver,sender_address, receiver_address, barcode)
             VALUES (%s,%s, %s, %s, %s, %s, %s, %s, %s)
             """,
-                (
-                    item["Category"],
-                    item["DeliveryCompany"],
-                    item["ShipmentContent"],
-                    item["Quantity"],
-                    item["SenderName"],
-                    item["ReceiverName"],
-                    item.get("SenderAddress", ""),  # optional fallback
-                    item.get("ReceiverAddress", ""),
-                    item.get("BarcodeNumber", []),
-                ),
+                shipment_row(item),
             )
 
         conn.commit()
+        if on_stored is not None:
+            on_stored()
         return (
             "Query executed and committed successfully!",
             item["Category"],
@@ -365,10 +579,12 @@ def store_shipment_data():
             conn.close()
 
 
-def store_non_shipment_data():
+@traced("db.insert")
+def store_non_shipment_data(items=None, on_stored=None):
     # Load JSON file
-    with open("server/non-shipment-summary.json") as f:
-        items = json.load(f)
+    if items is None:
+        with open("server/non-shipment-summary.json") as f:
+            items = json.load(f)
 
     
     # Ensure `items` is always a list of dicts
@@ -384,30 +600,29 @@ def store_non_shipment_data():
     quantity (int): the quantity of the item
     price (str): the price of the item
     """
+    if not items:
+        return ("Error occurred:", "Extraction returned no items")
+    if db_writer is not None:
+        db_writer.put("non_shipment_invoice", [non_shipment_row(item) for item in items], on_stored)
+        item = items[-1]
+        return (
+            "Queued for write-behind insert",
+            item["Category"],
+            item["Name"],
+            item["Raw_data"],
+            item["Total_Price"],
+            item["SST"],
+            item["Service_Charge"],
+        )
+
     # Connect to PostgreSQL
     try:
-        conn = psycopg2.connect(
-            dbname=database,
-            user=user,
-            password=password,
-            host="localhost",
-            port="5432",
-        )
+        conn = connect_db()
 
         # Create a cursor
         cur = conn.cursor()
 
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS non_shipment_invoice (
-                id SERIAL PRIMARY KEY,
-                category VARCHAR(100),
-                name VARCHAR(100),
-                raw_data VARCHAR(5000),
-                total_price VARCHAR(100),
-                SST VARCHAR(100),
-                Service_Charge VARCHAR(100)
-            )
-        """)
+        cur.execute(NON_SHIPMENT_TABLE)
 
         for item in items:
 
@@ -416,17 +631,12 @@ def store_non_shipment_data():
                 INSERT INTO non_shipment_invoice (category, name, raw_data, total_price, SST, Service_Charge)
                 VALUES (%s, %s, %s, %s, %s, %s)
                 """,
-                (
-                    item["Category"],
-                    item["Name"],
-                    item["Raw_data"],
-                    item["Total_Price"],
-                    item["SST"],
-                    item["Service_Charge"],
-                ),
+                non_shipment_row(item),
             )
 
         conn.commit()
+        if on_stored is not None:
+            on_stored()
         return (
             "Query executed and committed successfully!",
             item["Category"],
@@ -446,37 +656,319 @@ def store_non_shipment_data():
             conn.close()
 
 
+# Model warm-up
+#
+# Loads both models with an explicit keep_alive so the first request after idle
+# doesn't pay the load time. Ollama keeps one KV cache per parallel slot, and each
+# request replaces its slot's cache, so priming several prompts would only leave
+# the last one cached. Only the categorize prompt is primed, since every request
+# starts with it; the summarize prompts are evaluated in full on their first use.
+# bench_warm.py shows the effect.
+def warm_models():
+    for model in ("qwen3:8b", "qwen2.5vl:7b"):
+        try:
+            response = requests.post(
+                "http://localhost:11434/api/generate",
+                json={"model": model, "keep_alive": ollama_keep_alive},
+            )
+            if response.status_code != 200:
+                raise RuntimeError(f"API error: {response.text}")
+        except Exception as e:
+            print(f"Warm-up of {model} failed: {e}")
+
+    payload = {
+        "model": "qwen3:8b",
+        "messages": [
+            {"role": "system", "content": CATEGORIZE_PROMPT},
+            {"role": "user", "content": "warm-up"},
+        ],
+        "stream": False,
+        "keep_alive": ollama_keep_alive,
+        "options": {"num_predict": 1},
+    }
+    try:
+        requests.post("http://localhost:11434/api/chat", json=payload)
+    except Exception as e:
+        print(f"Prompt warm-up failed: {e}")
+
+
+def keep_warm():
+    while True:
+        warm_models()
+        if warm_interval <= 0:
+            return
+        time.sleep(warm_interval)
+
+
+@app.on_event("startup")
+def start_warm_up():
+    threading.Thread(target=keep_warm, name="keep-warm", daemon=True).start()
+
+
+# Speculative extraction
+#
+# categorize and summarize_* are two sequential LLM calls. In speculative mode the
+# extraction that looks more likely (from a cheap address-pattern prior) starts
+# alongside categorize, and is kept or discarded once the real category arrives.
+SPECULATIVE_CATEGORY = "unknown"
+
+SHIPMENT_HINTS = re.compile(
+    r"\b(ship(ping|ment)?\s*(to|from|no|number)|sender|receiver|recipient|consignee"
+    r"|tracking|waybill|awb|order\s*no|deliver(y|ed)\s*to)\b",
+    re.IGNORECASE,
+)
+ADDRESS_WORDS = re.compile(
+    r"\b(jalan|jln|taman|lorong|persiaran|street|road|avenue|block|blk|unit|floor|lot)\b",
+    re.IGNORECASE,
+)
+POSTCODE = re.compile(r"\b\d{5}\b")
+
+speculation_executor = ThreadPoolExecutor(
+    max_workers=max(speculative_max_inflight, 1), thread_name_prefix="speculate"
+)
+speculation_slots = threading.BoundedSemaphore(max(speculative_max_inflight, 1))
+speculation_lock = threading.Lock()
+speculation_stats = {
+    "attempted": 0,
+    "hits": 0,
+    "misses": 0,
+    "unusable": 0,
+    "skipped_saturated": 0,
+    "skipped_max_inflight": 0,
+    "saved_seconds": 0.0,
+    "wasted_seconds": 0.0,
+}
+
+
+def count_speculation(key, amount=1):
+    with speculation_lock:
+        speculation_stats[key] += amount
+
+
+def guess_shipment(content):
+    """Cheap prior: shipping keywords and address fragments suggest a shipment."""
+    score = (
+        2 * len(SHIPMENT_HINTS.findall(content))
+        + len(ADDRESS_WORDS.findall(content))
+        + len(POSTCODE.findall(content))
+    )
+    return score >= 3
+
+
+def start_speculation(content):
+    """Start the likelier extraction in the background.
+
+    Returns (kind, future) or None when Ollama has no free slot for it besides
+    the one categorize is about to use, so a saturated backend is not loaded with
+    work that may be thrown away, or when speculative_max_inflight is reached.
+    """
+    with ollama_inflight_lock:
+        saturated = ollama_inflight + 2 > ollama_num_parallel
+    if saturated:
+        count_speculation("skipped_saturated")
+        return None
+    if not speculation_slots.acquire(blocking=False):
+        count_speculation("skipped_max_inflight")
+        return None
+
+    kind = "shipment" if guess_shipment(content) else "non shipment"
+    extract = extract_shipment if kind == "shipment" else extract_non_shipment
+    started = time.perf_counter()
+    cancel = threading.Event()
+
+    def run():
+        try:
+            return extract(content, SPECULATIVE_CATEGORY, cancel=cancel)
+        finally:
+            speculation_slots.release()
+
+    count_speculation("attempted")
+    # Run in a copy of the request context so its spans land in the same trace
+    future = speculation_executor.submit(contextvars.copy_context().run, run)
+    future.started = started
+    future.cancel_event = cancel
+    return kind, future
+
+
+def discard_speculation(speculation):
+    if speculation is None:
+        return
+    _, future = speculation
+    if future.cancel():
+        # run() never starts, so its finally can't give the slot back
+        speculation_slots.release()
+        return
+    # Stops the streamed generation in Ollama instead of letting it run to completion
+    future.cancel_event.set()
+
+    def account(done):
+        count_speculation("wasted_seconds", time.perf_counter() - done.started)
+
+    future.add_done_callback(account)
+
+
+def finish_speculation(speculation, kind, category):
+    """Return the speculative extraction as parsed items, or None to extract normally."""
+    if speculation is None:
+        return None
+    guessed, future = speculation
+    if guessed != kind:
+        count_speculation("misses")
+        discard_speculation(speculation)
+        return None
+
+    waited = time.perf_counter()
+    try:
+        raw = future.result()
+    except Exception as e:
+        print("Speculative extraction failed:", e)
+        count_speculation("unusable")
+        count_speculation("wasted_seconds", time.perf_counter() - future.started)
+        return None
+
+    items = clean_and_validate_json(raw)
+    if isinstance(items, dict):
+        items = [items]
+    if not items or not all(isinstance(item, dict) for item in items):
+        count_speculation("unusable")
+        count_speculation("wasted_seconds", time.perf_counter() - future.started)
+        return None
+
+    for item in items:
+        item["Category"] = category
+    count_speculation("hits")
+    # Time the extraction ran in parallel with categorize
+    count_speculation("saved_seconds", waited - future.started)
+    return items
+
+
+def extract_and_store(content):
+    speculation = start_speculation(content) if speculative else None
+    try:
+        category=categorize(content)
+        print(category)
+        data = json.loads(category)
+    except Exception:
+        discard_speculation(speculation)
+        raise
+
+    if data.get("shipment"):
+        print("sumarizing shipment")
+        category=data["shipment"]
+        items = finish_speculation(speculation, "shipment", category)
+        if items is None:
+            summary = summarize_shipment(content,category)
+            print(summary)
+        else:
+            with open("server/shipment-summary.json", "w", encoding="utf-8") as f:
+                json.dump(items, f, ensure_ascii=False, indent=2)
+        result = store_shipment_data()
+        print(result)
+        return result
+
+    elif data.get("non shipment"):
+        print("sumarizing non shipment")
+        category=data["non shipment"]
+        items = finish_speculation(speculation, "non shipment", category)
+        if items is None:
+            summary = summarize_non_shipment(content,category)
+            print(summary)
+        else:
+            with open("server/non-shipment-summary.json", "w", encoding="utf-8") as f:
+                json.dump(items, f, ensure_ascii=False, indent=2)
+        result = store_non_shipment_data()
+        print(result)
+        return result
+    else:
+        discard_speculation(speculation)
+        return HTTPException(status_code=400, detail="no data provided")
+
+
+# Near-duplicate detection
+#
+# Photos of the same label from slightly different angles or crops have perceptual
+# hashes a few bits apart, so they are caught before paying for OCR and the LLM calls.
+dedup_index = NearDuplicateIndex(max_distance=dedup_max_distance, capacity=dedup_capacity)
+dedup_flagged_lock = threading.Lock()
+
+
+def record_flagged_duplicate(image_bytes, image_hash, response):
+    """Keep a skipped upload and why it was skipped, so a false positive isn't lost."""
+    try:
+        with dedup_flagged_lock:
+            os.makedirs(dedup_flagged_dir, exist_ok=True)
+            # The trace ID can come from the client, so it never goes into a path
+            image_path = os.path.join(dedup_flagged_dir, f"{uuid.uuid4().hex}.img")
+            with open(image_path, "wb") as f:
+                f.write(image_bytes)
+            record = {
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "trace_id": trace_id(),
+                "duplicate_of": response["duplicate_of"],
+                "distance": response["distance"],
+                "hash": f"{image_hash:016x}",
+                "image": image_path,
+            }
+            with open(os.path.join(dedup_flagged_dir, "flagged.jsonl"), "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+    except OSError as e:
+        print("Could not record flagged duplicate:", e)
+
+
+def find_near_duplicate(image_bytes):
+    """Return (image_hash, response for a near-duplicate or None)."""
+    with span("dedup.lookup") as attrs:
+        try:
+            image_hash = HASHES[dedup_hash](image_bytes)
+        except Exception as e:
+            print("Could not hash image:", e)
+            return None, None
+        match = dedup_index.lookup(image_hash)
+        attrs["hit"] = match is not None
+
+    if match is None:
+        return image_hash, None
+
+    distance, previous = match
+    print(f"Near-duplicate of {previous['trace_id']} (distance {distance})")
+    response = {"duplicate": True, "duplicate_of": previous["trace_id"], "distance": distance}
+    if dedup_mode == "cache":
+        response["result"] = previous["result"]
+    return image_hash, response
+
+
+def process_image(image_bytes, ocr):
+    image_hash = None
+    if dedup_mode != "off":
+        image_hash, duplicate = find_near_duplicate(image_bytes)
+        if duplicate is not None:
+            record_flagged_duplicate(image_bytes, image_hash, duplicate)
+            return duplicate
+
+    content = ocr(image_bytes)
+    print(content)
+    result = extract_and_store(content)
+
+    # Only remember receipts that were actually stored, and their extraction only when
+    # it will be served again, since it can be thousands of characters per entry
+    if image_hash is not None and isinstance(result, tuple) and result[0] != "Error occurred:":
+        entry = {"trace_id": trace_id()}
+        if dedup_mode == "cache":
+            entry["result"] = result
+        dedup_index.add(image_hash, entry)
+    return result
+
+
 @app.post("/deepseek-ocr")
 async def deepseek_ocr_endpoint(
     file: UploadFile = File(None),
 ):
     try:
         if file:
-            image_bytes = await file.read()
-            content = deepseek_ocr(image_bytes)
-            print(content)
-            category=categorize(content)
-            print(category)
-            data = json.loads(category) 
-            if data.get("shipment"):
-                print("sumarizing shipment")
-                category=data["shipment"]
-                summary = summarize_shipment(content,category)
-                print(summary)
-                result = store_shipment_data()
-                print(result)
-                return result
-            
-            elif data.get("non shipment"):
-                print("sumarizing non shipment")
-                category=data["non shipment"]
-                summary = summarize_non_shipment(content,category)
-                print(summary)
-                result = store_non_shipment_data()
-                print(result)
-                return result
-            else:
-                return HTTPException(status_code=400, detail="no data provided")
+            with span("upload.read"):
+                image_bytes = await file.read()
+            with profiler.capture(f"deepseek-ocr {trace_id()}"):
+                return process_image(image_bytes, deepseek_ocr)
         else:
             raise HTTPException(status_code=400, detail="No image provided")
 
@@ -489,31 +981,10 @@ async def ollama_ocr_endpoint(
 ):
     try:
         if file:
-            image_bytes = await file.read()
-            content = ollama_ocr(image_bytes)
-            print(content)
-            category=categorize(content)
-            print(category)
-            data = json.loads(category) 
-            if data.get("shipment"):
-                print("sumarizing shipment")
-                category=data["shipment"]
-                summary = summarize_shipment(content,category)
-                print(summary)
-                result = store_shipment_data()
-                print(result)
-                return result
-            
-            elif data.get("non shipment"):
-                print("sumarizing non shipment")
-                category=data["non shipment"]
-                summary = summarize_non_shipment(content,category)
-                print(summary)
-                result = store_non_shipment_data()
-                print(result)
-                return result
-            else:
-                return HTTPException(status_code=400, detail="no data provided")
+            with span("upload.read"):
+                image_bytes = await file.read()
+            with profiler.capture(f"ollama-ocr {trace_id()}"):
+                return process_image(image_bytes, ollama_ocr)
         else:
             raise HTTPException(status_code=400, detail="No image provided")
 
@@ -521,6 +992,75 @@ async def ollama_ocr_endpoint(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.middleware("http")
+async def trace_request(request: Request, call_next):
+    with start_trace(request.headers.get("X-Trace-Id"), enabled=tracing) as trace:
+        response = await call_next(request)
+    response.headers["X-Trace-Id"] = trace.trace_id
+    return response
+
+
+def check_admin(token):
+    if not admin_token or not hmac.compare_digest((token or "").encode(), admin_token.encode()):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+
+@app.post("/admin/profile")
+def arm_profiler(count: int = 1, x_admin_token: str = Header(None)):
+    """Capture a cProfile of the next `count` OCR requests."""
+    check_admin(x_admin_token)
+    profiler.arm(count)
+    return {"armed": count}
+
+
+@app.get("/admin/profile")
+def get_profiles(x_admin_token: str = Header(None)):
+    """Return (and clear) the profiles captured since the profiler was armed."""
+    check_admin(x_admin_token)
+    return profiler.collect()
+
+
+@app.get("/export/{table}")
+def export_invoices(
+    table: str,
+    format: str = "csv",
+    start: date = None,
+    end: date = None,
+    category: str = None,
+    company: str = None,
+    x_admin_token: str = Header(None),
+):
+    """Stream shipment_invoice or non_shipment_invoice as csv, jsonl or parquet."""
+    check_admin(x_admin_token)
+    if table not in EXPORT_TABLES:
+        raise HTTPException(status_code=404, detail=f"Unknown table: {table}")
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown format: {format}")
+
+    filters = dict(start=start, end=end, category=category, company=company)
+    try:
+        chunks = export(connect_db, table, format, filters)
+    except RuntimeError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    media_type, extension = EXPORT_FORMATS[format]
+    return StreamingResponse(
+        chunks,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{table}{extension}"'},
+    )
+
+
+@app.get("/metrics/speculation")
+def speculation_metrics():
+    with speculation_lock:
+        stats = dict(speculation_stats)
+    decided = stats["hits"] + stats["misses"] + stats["unusable"]
+    stats["enabled"] = speculative
+    stats["hit_rate"] = stats["hits"] / decided if decided else None
+    return stats
+
+
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=1234)
@@ -0,0 +1,53 @@
+import db
+
+
+class FakeCursor:
+    def __init__(self, columns):
+        self.columns = columns
+        self.statements = []
+        self.row = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        self.statements.append(sql)
+        if params is not None:
+            self.row = (1,) if params in self.columns else None
+
+    def fetchone(self):
+        return self.row
+
+
+class FakeConnection:
+    def __init__(self, cursor):
+        self.cur = cursor
+
+    def cursor(self):
+        return self.cur
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def run_migrations(monkeypatch, columns):
+    cur = FakeCursor(columns)
+    monkeypatch.setattr(db, "connect_db", lambda: FakeConnection(cur))
+    db.migrate_db()
+    return [sql for sql in cur.statements if sql.startswith("ALTER")]
+
+
+def test_migration_skips_existing_columns(monkeypatch):
+    columns = {("shipment_invoice", "created_at"), ("non_shipment_invoice", "created_at")}
+    assert run_migrations(monkeypatch, columns) == []
+
+
+def test_migration_adds_missing_columns(monkeypatch):
+    altered = run_migrations(monkeypatch, {("shipment_invoice", "created_at")})
+    assert len(altered) == 1 and "non_shipment_invoice" in altered[0]
@@ -0,0 +1,204 @@
+import csv
+import io
+import json
+import time
+
+import pytest
+
+from db_writer import WriteBehindWriter, array_literal, copy_value
+
+
+def parse_array(literal):
+    """Parse a one-dimensional Postgres array literal of quoted elements."""
+    assert literal[0] == "{" and literal[-1] == "}"
+    values, i, body = [], 0, literal[1:-1]
+    while i < len(body):
+        assert body[i] == '"'
+        i += 1
+        value = []
+        while body[i] != '"':
+            if body[i] == "\\":
+                i += 1
+            value.append(body[i])
+            i += 1
+        values.append("".join(value))
+        i += 1
+        if i < len(body):
+            assert body[i] == ","
+            i += 1
+    return values
+
+
+def test_array_literal():
+    assert array_literal([]) == "{}"
+    assert array_literal(["SPX1", "SPX2"]) == '{"SPX1","SPX2"}'
+    assert array_literal([1, 2.5]) == '{"1","2.5"}'
+
+
+@pytest.mark.parametrize(
+    "values",
+    [
+        ['say "hi"'],
+        ["back\\slash", "trailing\\"],
+        ["a,b", "{braces}", "NULL", "", " spaced "],
+        ["multi\nline", "tab\there", "unicode ✔"],
+    ],
+)
+def test_array_literal_round_trip(values):
+    assert parse_array(array_literal(values)) == values
+
+
+def test_copy_value():
+    assert copy_value(None) == "\\N"
+    assert copy_value(["A1"]) == '{"A1"}'
+    assert copy_value(("A1", "B2")) == '{"A1","B2"}'
+    assert copy_value("text") == "text"
+    assert copy_value(3) == 3
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql):
+        pass
+
+    def copy_expert(self, sql, buffer):
+        data = buffer.getvalue()
+        if "BAD" in data:
+            raise ValueError("bad row")
+        self.conn.copied.append(data)
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, fail_commit=False):
+        self.fail_commit = fail_commit
+        self.copied = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        if self.fail_commit:
+            raise RuntimeError("commit failed")
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def make_writer(conn, tmp_path):
+    tables = {"shipment_invoice": ("CREATE TABLE ...", ("category", "sender", "barcode"))}
+    return WriteBehindWriter(lambda: conn, tables, 10, 1, str(tmp_path / "spill.jsonl"))
+
+
+def spilled(writer):
+    with open(writer.spill_path, encoding="utf-8") as f:
+        return [json.loads(line)["row"] for line in f]
+
+
+def test_copy_encodes_rows_as_csv(tmp_path):
+    conn = FakeConnection()
+    writer = make_writer(conn, tmp_path)
+    row = ("shipment", 'Ali "Boss", Sdn Bhd', ['SPX"1', "SPX\\2"])
+    writer.put("shipment_invoice", [row, ("shipment", None, [])])
+    writer.flush(writer.drain())
+
+    first, second = csv.reader(io.StringIO(conn.copied[0]))
+    assert first[:2] == ["shipment", 'Ali "Boss", Sdn Bhd']
+    assert parse_array(first[2]) == ['SPX"1', "SPX\\2"]
+    assert second == ["shipment", "\\N", "{}"]
+
+
+def test_bad_rows_are_spilled_once_after_commit(tmp_path):
+    conn = FakeConnection()
+    writer = make_writer(conn, tmp_path)
+    stored = []
+    writer.put("shipment_invoice", [("a", "ok", []), ("b", "BAD", []), ("c", "ok", [])], lambda: stored.append(1))
+    writer.flush(writer.drain())
+
+    assert spilled(writer) == [["b", "BAD", []]]
+    assert len(conn.copied) == 2
+    assert stored == [1]
+
+
+def test_failed_commit_spills_the_batch_once(tmp_path):
+    conn = FakeConnection(fail_commit=True)
+    writer = make_writer(conn, tmp_path)
+    stored = []
+    writer.put("shipment_invoice", [("a", "ok", []), ("b", "BAD", [])], lambda: stored.append(1))
+    writer.flush(writer.drain())
+
+    assert spilled(writer) == [["a", "ok", []], ["b", "BAD", []]]
+    assert stored == [1]
+
+
+class UnwritableSpill:
+    """Stands in for a full disk: spilling fails until `fixed` is set."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.real_spill = writer.spill
+        self.fixed = False
+
+    def __call__(self, batch, error):
+        if not self.fixed:
+            raise OSError("No space left on device")
+        self.real_spill(batch, error)
+
+
+def test_start_creates_the_spill_directory(tmp_path):
+    writer = WriteBehindWriter(FakeConnection, {}, spill_path=str(tmp_path / "missing" / "spill.jsonl"))
+    writer.start()
+    writer.close()
+    assert (tmp_path / "missing").is_dir()
+
+
+def test_rows_are_kept_when_they_cannot_be_spilled(tmp_path):
+    writer = make_writer(FakeConnection(fail_commit=True), tmp_path)
+    writer.spill = UnwritableSpill(writer)
+    stored = []
+    writer.put("shipment_invoice", [("a", "ok", []), ("b", "ok", [])], lambda: stored.append(1))
+
+    unsaved = writer.flush(writer.drain())
+    assert [row for _, row, _ in unsaved] == [("a", "ok", []), ("b", "ok", [])]
+    assert stored == []
+
+    writer.spill.fixed = True
+    assert writer.flush(unsaved) == []
+    assert spilled(writer) == [["a", "ok", []], ["b", "ok", []]]
+    assert stored == [1]
+
+
+def test_writer_thread_survives_spill_failures(tmp_path):
+    conn = FakeConnection(fail_commit=True)
+    writer = make_writer(conn, tmp_path)
+    writer.flush_interval = 0.01
+    writer.spill = UnwritableSpill(writer)
+    stored = []
+    writer.start()
+    writer.put("shipment_invoice", [("a", "ok", [])], lambda: stored.append(1))
+    time.sleep(0.1)
+    assert writer.thread.is_alive()
+    assert stored == []
+
+    conn.fail_commit = False
+    writer.close()
+    assert stored == [1]
+
+
+def test_callback_waits_for_every_row(tmp_path):
+    conn = FakeConnection()
+    writer = make_writer(conn, tmp_path)
+    stored = []
+    writer.put("shipment_invoice", [("a", "ok", []), ("b", "ok", []), ("c", "ok", [])], lambda: stored.append(1))
+    batch = writer.drain()
+    writer.flush(batch[1:])
+    assert stored == []
+    writer.flush(batch[:1])
+    assert stored == [1]
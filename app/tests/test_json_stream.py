@@ -0,0 +1,96 @@
+import json
+
+import pytest
+
+from json_stream import JsonStreamScanner, StreamAbort
+
+
+def feed_all(scanner, text, size=1):
+    """Feed text in chunks of `size`, returning what the last feed() returned."""
+    closed = False
+    for i in range(0, len(text), size):
+        closed = scanner.feed(text[i:i + size])
+    return closed
+
+
+@pytest.mark.parametrize("size", [1, 3, 1000])
+def test_closes_on_top_level_object(size):
+    scanner = JsonStreamScanner()
+    assert feed_all(scanner, '{"a": [1, {"b": 2}]} trailing text', size)
+    assert scanner.closed
+    assert scanner.json_text == '{"a": [1, {"b": 2}]}'
+
+
+def test_closes_on_top_level_array():
+    scanner = JsonStreamScanner()
+    assert scanner.feed('[{"a": 1}, {"a": 2}]')
+    assert scanner.json_text == '[{"a": 1}, {"a": 2}]'
+
+
+def test_brackets_and_escaped_quotes_in_strings_do_not_close():
+    scanner = JsonStreamScanner()
+    assert not scanner.feed('{"a": "}]\\" still a string {"')
+    assert scanner.feed("}")
+    assert scanner.json_text == '{"a": "}]\\" still a string {"}'
+
+
+def test_feed_after_close_is_ignored():
+    scanner = JsonStreamScanner()
+    scanner.feed('{"a": 1}')
+    assert scanner.feed('{"b": 2}')
+    assert scanner.json_text == '{"a": 1}'
+
+
+def test_open_json_is_not_closed():
+    scanner = JsonStreamScanner()
+    assert not scanner.feed('{"a": [1, 2')
+    assert not scanner.closed
+    assert scanner.text == '{"a": [1, 2'
+
+
+def test_skips_think_block_and_fence():
+    scanner = JsonStreamScanner()
+    text = '<think>maybe {"not": "this"}</think>\n```json\n{"a": 1}\n```'
+    assert feed_all(scanner, text)
+    assert scanner.json_text == '{"a": 1}'
+
+
+def test_long_think_block_is_not_prose():
+    scanner = JsonStreamScanner(max_preamble=20)
+    scanner.feed("<think>")
+    for i in range(500):
+        scanner.feed(f"step {i} of the reasoning ")
+    scanner.feed("</think>")
+    assert scanner.feed('{"a": 1}')
+
+
+def test_aborts_on_prose_before_json():
+    scanner = JsonStreamScanner(max_preamble=20)
+    with pytest.raises(StreamAbort, match="prose"):
+        feed_all(scanner, "Sure! Here is the extracted data you asked for: {", 5)
+
+
+def test_aborts_on_runaway_string():
+    scanner = JsonStreamScanner()
+    scanner.feed('{"Raw_data": "')
+    with pytest.raises(StreamAbort, match="repetition"):
+        for _ in range(1000):
+            scanner.feed("Nasi Lemak ")
+
+
+def test_repeated_identical_elements_are_valid():
+    scanner = JsonStreamScanner()
+    items = ", ".join(['{"BarcodeNumber": ["SPX1"]}'] * 200)
+    assert feed_all(scanner, f"[{items}]", 7)
+
+    scanner = JsonStreamScanner()
+    assert feed_all(scanner, "[" + ", ".join(['"SPX1"'] * 300) + "]", 7)
+
+
+@pytest.mark.parametrize("lines", [30, 250])
+def test_repeated_receipt_lines_in_raw_data_are_valid(lines):
+    item = {"Name": "KEDAI MAKAN ABC", "Raw_data": "Nasi Lemak 1 RM5.00\n" * lines}
+    text = json.dumps(item)
+    scanner = JsonStreamScanner()
+    assert feed_all(scanner, text, 4)
+    assert json.loads(scanner.json_text) == item
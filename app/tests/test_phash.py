@@ -0,0 +1,67 @@
+import random
+
+import pytest
+
+pytest.importorskip("numpy")
+
+from phash import NearDuplicateIndex
+
+
+def brute_force(entries, value, max_distance):
+    """Smallest Hamming distance to any entry, if within max_distance."""
+    distances = [(value ^ other).bit_count() for other in entries]
+    best = min(distances, default=None)
+    return best if best is not None and best <= max_distance else None
+
+
+def flip_bits(value, count, rng):
+    for bit in rng.sample(range(64), count):
+        value ^= 1 << bit
+    return value
+
+
+@pytest.mark.parametrize("max_distance", [0, 3, 6, 10])
+def test_lookup_matches_brute_force(max_distance):
+    rng = random.Random(max_distance)
+    index = NearDuplicateIndex(max_distance=max_distance)
+    entries = [rng.getrandbits(64) for _ in range(500)]
+    for value in entries:
+        index.add(value, value)
+
+    # Near copies of stored hashes, plus unrelated hashes that should miss
+    queries = [flip_bits(rng.choice(entries), rng.randint(0, 12), rng) for _ in range(500)]
+    queries += [rng.getrandbits(64) for _ in range(100)]
+    for query in queries:
+        expected = brute_force(entries, query, max_distance)
+        match = index.lookup(query)
+        if expected is None:
+            assert match is None
+        else:
+            distance, payload = match
+            assert distance == expected
+            assert (query ^ payload).bit_count() == distance
+
+
+def test_eviction_keeps_only_the_newest_entries():
+    rng = random.Random(1)
+    index = NearDuplicateIndex(max_distance=4, capacity=50)
+    entries = [rng.getrandbits(64) for _ in range(200)]
+    for value in entries:
+        index.add(value, value)
+
+    assert len(index) == 50
+    kept, evicted = entries[-50:], entries[:-50]
+    for value in kept:
+        assert index.lookup(value) == (0, value)
+    for value in evicted:
+        match = index.lookup(value)
+        expected = brute_force(kept, value, 4)
+        assert (match is None) == (expected is None)
+        if match is not None:
+            assert match[0] == expected
+
+    # Evicted entries leave no ids behind in the buckets
+    live = set(index.entries)
+    for table in index.tables:
+        for bucket in table.values():
+            assert bucket and bucket <= live
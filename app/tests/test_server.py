@@ -0,0 +1,86 @@
+import os
+
+import pytest
+
+pytest.importorskip("fastapi.testclient")
+server = pytest.importorskip("server")
+
+from fastapi.testclient import TestClient
+
+
+def test_flagged_duplicate_ignores_hostile_trace_id(tmp_path, monkeypatch):
+    flagged_dir = tmp_path / "flagged"
+    monkeypatch.setattr(server, "dedup_mode", "flag")
+    monkeypatch.setattr(server, "dedup_flagged_dir", str(flagged_dir))
+    monkeypatch.setattr(
+        server,
+        "find_near_duplicate",
+        lambda image_bytes: (0x1234, {"duplicate": True, "duplicate_of": "earlier", "distance": 1}),
+    )
+    client = TestClient(server.app)
+
+    hostile = [os.path.join("..", "..", "escaped"), str(tmp_path / "absolute")]
+    for trace_id in hostile + hostile:
+        response = client.post(
+            "/ollama-ocr",
+            files={"file": ("receipt.jpeg", b"image bytes")},
+            headers={"X-Trace-Id": trace_id},
+        )
+        assert response.status_code == 200
+        assert response.json()["duplicate_of"] == "earlier"
+
+    # Every upload is kept, under a name the server chose, inside the flagged directory
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["flagged"]
+    images = [name for name in os.listdir(flagged_dir) if name.endswith(".img")]
+    assert len(images) == 4
+    with open(flagged_dir / "flagged.jsonl", encoding="utf-8") as f:
+        assert len(f.readlines()) == 4
+
+
+def test_admin_token_is_required(monkeypatch):
+    monkeypatch.setattr(server, "admin_token", "secret")
+    client = TestClient(server.app)
+    assert client.get("/admin/profile").status_code == 403
+    assert client.get("/admin/profile", headers={"X-Admin-Token": "wrong"}).status_code == 403
+    assert client.get("/admin/profile", headers={"X-Admin-Token": "secret"}).status_code == 200
+
+    monkeypatch.setattr(server, "admin_token", None)
+    assert client.get("/admin/profile", headers={"X-Admin-Token": "secret"}).status_code == 403
+
+
+@pytest.mark.parametrize("store", ["store_shipment_data", "store_non_shipment_data"])
+def test_storing_no_items_is_an_error(store, monkeypatch):
+    monkeypatch.setattr(server, "db_writer", object())
+    result = getattr(server, store)([])
+    assert result[0] == "Error occurred:"
+
+
+def test_ollama_chat_counts_calls_in_flight(monkeypatch):
+    seen = []
+    monkeypatch.setattr(server, "send_chat", lambda payload, cancel=None: seen.append(server.ollama_inflight))
+    server.ollama_chat({"model": "qwen3:8b"})
+    assert seen == [1]
+    assert server.ollama_inflight == 0
+
+
+def test_speculation_skipped_when_ollama_is_saturated(monkeypatch):
+    monkeypatch.setattr(server, "ollama_num_parallel", 2)
+    monkeypatch.setattr(server, "ollama_inflight", 1)
+    monkeypatch.setattr(server, "speculation_stats", dict(server.speculation_stats, skipped_saturated=0))
+    assert server.start_speculation("receipt") is None
+    assert server.speculation_stats["skipped_saturated"] == 1
+
+
+def test_unusable_speculation_counts_as_wasted(monkeypatch):
+    monkeypatch.setattr(server, "ollama_num_parallel", 4)
+    monkeypatch.setattr(server, "ollama_inflight", 0)
+    monkeypatch.setattr(server, "speculation_stats", {key: 0 for key in server.speculation_stats})
+    monkeypatch.setattr(server, "extract_non_shipment", lambda content, category, cancel=None: "not json")
+    speculation = server.start_speculation("Nasi Lemak RM5.00")
+    assert speculation is not None
+
+    assert server.finish_speculation(speculation, "non shipment", "meal") is None
+    stats = server.speculation_stats
+    assert stats["unusable"] == 1
+    assert stats["wasted_seconds"] > 0
+    assert stats["saved_seconds"] == 0
@@ -0,0 +1,19 @@
+import pytest
+
+from tracing import start_trace, trace_id
+
+
+def test_keeps_well_formed_incoming_id():
+    with start_trace("abc-123") as trace:
+        assert trace.trace_id == "abc-123"
+        assert trace_id() == "abc-123"
+
+
+@pytest.mark.parametrize(
+    "incoming",
+    [None, "", "../../etc/passwd", "/etc/x", "id with spaces", "a" * 65, "abc\r\nX-Injected: 1", "ünï"],
+)
+def test_replaces_missing_or_malformed_id(incoming):
+    with start_trace(incoming) as trace:
+        assert trace.trace_id != incoming
+        assert len(trace.trace_id) == 32 and trace.trace_id.isalnum()
@@ -0,0 +1,180 @@
+import contextvars
+import cProfile
+import functools
+import io
+import pstats
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+current_trace_id = contextvars.ContextVar("current_trace_id", default=None)
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+# Incoming IDs end up in logs, response headers and other services' requests
+TRACE_ID_PATTERN = re.compile(r"[A-Za-z0-9-]{1,64}")
+
+
+class Trace:
+    """Span timings collected for one request."""
+
+    def __init__(self, trace_id):
+        self.trace_id = trace_id
+        self.started = time.perf_counter()
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def add(self, name, started, seconds, attrs):
+        with self.lock:
+            self.spans.append(
+                {
+                    "name": name,
+                    "start": round(started - self.started, 4),
+                    "seconds": round(seconds, 4),
+                    **attrs,
+                }
+            )
+
+    def total(self, name):
+        """Sum of a numeric attribute (or "seconds") over all spans."""
+        with self.lock:
+            return sum(s.get(name, 0) for s in self.spans)
+
+    def summary(self):
+        total = time.perf_counter() - self.started
+        with self.lock:
+            spans = sorted(self.spans, key=lambda s: s["start"])
+        parts = " | ".join(f"{s['name']} {s['seconds']:.2f}s" for s in spans)
+        return f"[trace {self.trace_id}] total {total:.2f}s | {parts}"
+
+
+def new_trace_id():
+    return uuid.uuid4().hex
+
+
+def trace_id():
+    return current_trace_id.get()
+
+
+def valid_trace_id(value):
+    return isinstance(value, str) and TRACE_ID_PATTERN.fullmatch(value) is not None
+
+
+@contextmanager
+def start_trace(incoming_id=None, enabled=False):
+    """Set the trace ID for the current request, and collect spans if enabled.
+
+    The trace ID is always set so it can be propagated; span collection (and the
+    summary line) only happens when tracing is enabled. An incoming ID that isn't
+    1-64 letters, digits or dashes is replaced with a new one.
+    """
+    trace = Trace(incoming_id if valid_trace_id(incoming_id) else new_trace_id())
+    id_token = current_trace_id.set(trace.trace_id)
+    trace_token = current_trace.set(trace if enabled else None)
+    try:
+        yield trace
+    finally:
+        current_trace.reset(trace_token)
+        current_trace_id.reset(id_token)
+        if enabled:
+            print(trace.summary())
+
+
+@contextmanager
+def span(name, **attrs):
+    """Time a block of work. Yields a dict the block can add attributes to."""
+    trace = current_trace.get()
+    if trace is None:
+        yield attrs
+        return
+
+    started = time.perf_counter()
+    try:
+        yield attrs
+    finally:
+        trace.add(name, started, time.perf_counter() - started, attrs)
+
+
+def traced(name):
+    """Decorator form of span() for whole functions."""
+
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if current_trace.get() is None:
+                return func(*args, **kwargs)
+            with span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+def parse_server_timing(header):
+    """Parse a Server-Timing header into {name: seconds}."""
+    timings = {}
+    for entry in header.split(","):
+        name, _, params = entry.strip().partition(";")
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if name and key == "dur":
+                timings[name] = float(value) / 1000
+    return timings
+
+
+class Profiler:
+    """cProfile capture for the next N requests, armed from an admin endpoint.
+
+    Only one request is profiled at a time, since cProfile hooks the whole thread.
+    """
+
+    def __init__(self, max_results=20):
+        self.remaining = 0
+        self.results = []
+        self.max_results = max_results
+        self.lock = threading.Lock()
+        self.busy = False
+
+    def arm(self, requests):
+        with self.lock:
+            self.remaining = requests
+            self.results = []
+
+    def collect(self):
+        with self.lock:
+            results, self.results = self.results, []
+            return {"remaining": self.remaining, "profiles": results}
+
+    @contextmanager
+    def capture(self, label):
+        # Cheap check first so unarmed requests never touch the lock
+        if not self.remaining or not self.claim():
+            yield
+            return
+
+        profile = cProfile.Profile()
+        started = time.perf_counter()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            elapsed = time.perf_counter() - started
+            output = io.StringIO()
+            pstats.Stats(profile, stream=output).sort_stats("cumulative").print_stats(40)
+            with self.lock:
+                self.busy = False
+                self.results.append(
+                    {"label": label, "seconds": round(elapsed, 3), "profile": output.getvalue()}
+                )
+                del self.results[:-self.max_results]
+
+    def claim(self):
+        with self.lock:
+            if self.busy or self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            self.busy = True
+            return True
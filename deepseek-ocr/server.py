@@ -1,60 +1,210 @@
-from fastapi import FastAPI, File, Form, UploadFile
+from fastapi import FastAPI, File, Form, UploadFile, Header
 from fastapi.responses import JSONResponse
-from PIL import Image
-import io
 import uvicorn
-from transformers import AutoModel, AutoTokenizer
-import torch
+import asyncio
 import os
 import io
+import re
 import contextlib
+import sys
+import tempfile
+import threading
+import time
+
+# transformers and torch are imported in load_model(), so the server (and the
+# health endpoint) come up without waiting for them.
 
 os.environ["CUDA_VISIBLE_DEVICES"] = '0'
 model_name = 'deepseek-ai/DeepSeek-OCR'
 
+# Offline mode: load from a pinned local snapshot without any hub lookups, e.g.
+#   huggingface-cli download deepseek-ai/DeepSeek-OCR --revision <commit> --local-dir models/DeepSeek-OCR
+#   MODEL_PATH=models/DeepSeek-OCR OCR_OFFLINE=1 python server.py --prod
+model_path = os.getenv("MODEL_PATH", model_name)
+model_revision = os.getenv("MODEL_REVISION")
+offline = os.getenv("OCR_OFFLINE", "0") == "1"
+if offline:
+    os.environ["HF_HUB_OFFLINE"] = "1"
+    os.environ["TRANSFORMERS_OFFLINE"] = "1"
+
+model = None
+tokenizer = None
+model_state = "not loaded"
+model_error = None
+model_lock = threading.Lock()
+# One inference at a time on the GPU
+infer_lock = threading.Lock()
+
 
 prompt = "Return all text on the image"
 output_path = '.'
 
+# Resolution modes, see main.py
+MODES = {
+    "tiny": dict(base_size=512, image_size=512, crop_mode=False),
+    "small": dict(base_size=640, image_size=640, crop_mode=False),
+    "base": dict(base_size=1024, image_size=1024, crop_mode=False),
+    "large": dict(base_size=1280, image_size=1280, crop_mode=False),
+    "gundam": dict(base_size=1024, image_size=640, crop_mode=True),
+}
+
 app = FastAPI(title="DeepSeek OCR API")
 
-@app.post("/deepseek")
-async def deepseek(image: UploadFile = File(...)): #prompt: str = Form("Free OCR.")):
-    try:
-        # Save the uploaded image temporarily
-        temp_path = f"/tmp/{image.filename}"
-        with open(temp_path, "wb") as f:
-            f.write(await image.read())
 
-        tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
-        model = AutoModel.from_pretrained(
-            model_name,
-            _attn_implementation='flash_attention_2',
-            trust_remote_code=True,
-            use_safetensors=True,
-            device_map="cuda:0"
-        ).eval().cuda().to(torch.bfloat16)
-
-        # Capture printed output
-        output_buffer = io.StringIO()
-        with contextlib.redirect_stdout(output_buffer):
+class ThreadStdout:
+    """sys.stdout that sends a capturing thread's prints to its own buffer.
+
+    model.infer() prints its result. contextlib.redirect_stdout swaps sys.stdout
+    for the whole process, which would also capture the logs of other requests
+    once inference runs in a worker thread.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def target(self):
+        return getattr(self.local, "buffer", None) or self.stream
+
+    def write(self, text):
+        return self.target().write(text)
+
+    def flush(self):
+        self.target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    @contextlib.contextmanager
+    def capture(self):
+        self.local.buffer = io.StringIO()
+        try:
+            yield self.local.buffer
+        finally:
+            self.local.buffer = None
+
+
+stdout = ThreadStdout(sys.stdout)
+sys.stdout = stdout
+
+
+def load_model():
+    """Load the model once; concurrent callers wait for the first load."""
+    global model, tokenizer, model_state, model_error
+    with model_lock:
+        if model is not None:
+            return model, tokenizer
+
+        model_state = "loading"
+        started = time.perf_counter()
+        try:
+            import torch
+            from transformers import AutoModel, AutoTokenizer
+
+            options = dict(trust_remote_code=True, local_files_only=offline)
+            if model_revision:
+                options["revision"] = model_revision
+            tokenizer = AutoTokenizer.from_pretrained(model_path, **options)
+            # safetensors shards are memory-mapped and placed straight on the GPU
+            model = AutoModel.from_pretrained(
+                model_path,
+                _attn_implementation='flash_attention_2',
+                use_safetensors=True,
+                low_cpu_mem_usage=True,
+                torch_dtype=torch.bfloat16,
+                device_map="cuda:0",
+                **options,
+            ).eval()
+        except Exception as e:
+            model_state = "error"
+            model_error = str(e)
+            raise
+
+        model_state = "ready"
+        model_error = None
+        print(f"Loaded {model_path} in {time.perf_counter() - started:.1f}s")
+        return model, tokenizer
+
+
+@app.on_event("startup")
+def preload_model():
+    # Load in the background so the server accepts requests (and health checks) right away
+    if os.getenv("OCR_PRELOAD", "1") == "1":
+        threading.Thread(target=load_model, name="load-model", daemon=True).start()
+
+
+def run_inference(model, tokenizer, image_file, mode, timings):
+    """Run one OCR inference (in a worker thread) and return what the model printed."""
+    started = time.perf_counter()
+    with infer_lock:
+        timings["infer_wait"] = time.perf_counter() - started
+        started = time.perf_counter()
+        with stdout.capture() as output_buffer:
             model.infer(
                 tokenizer,
                 prompt=prompt,
-                image_file=temp_path,
+                image_file=image_file,
                 output_path=output_path,
-                base_size=1024,
-                image_size=640,
-                crop_mode=True,
+                **MODES[mode],
                 save_results=True,
                 test_compress=True
             )
+        timings["model_infer"] = time.perf_counter() - started
+    return output_buffer.getvalue().strip()
 
-        printed_output = output_buffer.getvalue().strip()
 
-        return JSONResponse({"result": printed_output or "No text captured."})
+@app.post("/deepseek")
+async def deepseek(image: UploadFile = File(...), mode: str = Form("gundam"), x_trace_id: str = Header(None)): #prompt: str = Form("Free OCR.")):
+    timings = {}
+    started = time.perf_counter()
+    if mode not in MODES:
+        return JSONResponse({"error": f"Unknown mode {mode!r}, expected one of {list(MODES)}"}, status_code=400)
+    temp_path = None
+    try:
+        # Save the uploaded image temporarily, under a unique name since requests overlap
+        suffix = os.path.splitext(os.path.basename(image.filename or ""))[1]
+        with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as f:
+            temp_path = f.name
+            f.write(await image.read())
+        timings["image_save"] = time.perf_counter() - started
+
+        # Only takes time while the model is still loading
+        started = time.perf_counter()
+        model, tokenizer = await asyncio.to_thread(load_model)
+        timings["model_load"] = time.perf_counter() - started
+
+        # Off the event loop, so /health and other requests are answered meanwhile
+        printed_output = await asyncio.to_thread(run_inference, model, tokenizer, temp_path, mode, timings)
+
+        return JSONResponse(
+            {
+                "result": printed_output or "No text captured.",
+                "mode": mode,
+                "tokens": len(tokenizer.encode(printed_output, add_special_tokens=False)),
+            },
+            headers=trace_headers(x_trace_id, timings),
+        )
     except Exception as e:
-        return JSONResponse({"error": str(e)}, status_code=500)
+        return JSONResponse({"error": str(e)}, status_code=500, headers=trace_headers(x_trace_id, timings))
+    finally:
+        if temp_path is not None:
+            os.remove(temp_path)
+
+
+TRACE_ID_PATTERN = re.compile(r"[A-Za-z0-9-]{1,64}")
+
+
+def trace_headers(trace_id, timings):
+    """Log the stage timings and return them as Server-Timing (milliseconds) for the caller."""
+    # Only echo IDs in the same format the app generates
+    if trace_id and not TRACE_ID_PATTERN.fullmatch(trace_id):
+        trace_id = None
+    if trace_id:
+        print(f"[trace {trace_id}] " + " | ".join(f"{k} {v:.2f}s" for k, v in timings.items()))
+    headers = {"Server-Timing": ", ".join(f"{k};dur={v * 1000:.1f}" for k, v in timings.items())}
+    if trace_id:
+        headers["X-Trace-Id"] = trace_id
+    return headers
     
 
 @app.get("/")
@@ -62,6 +212,15 @@ def root():
     return {"message": "DeepSeek OCR FastAPI server is running."}
 
 
+@app.get("/health")
+def health():
+    return {"status": "ok", "model": model_state, "model_path": model_path, "error": model_error}
+
+
 if __name__ == "__main__":
-    # Run FastAPI with Uvicorn directly
-    uvicorn.run("server:app", host="0.0.0.0", port=4896, reload=True)
+    if "--prod" in sys.argv:
+        # No reloader: it would import (and load) everything a second time
+        uvicorn.run(app, host="0.0.0.0", port=4896)
+    else:
+        # Run FastAPI with Uvicorn directly
+        uvicorn.run("server:app", host="0.0.0.0", port=4896, reload=True)